@@ -19,25 +19,30 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import atexit
+import concurrent.futures
 import contextlib
 import ctypes
 import ctypes.util
 import errno
+import functools
 import glob
 import imp
+import io
+import json
+import mmap
+import multiprocessing
 import os
-import py_compile
 import re
+import shlex
 import shutil
-import socket
 import stat
 import struct
 import subprocess
 import sys
-import tarfile
 import tempfile
+import threading
 import time
-import zipfile
 
 
 def ensureenv():
@@ -48,10 +53,29 @@ def ensureenv():
     """
     if not os.path.exists("build/env"):
         return
+
+    # Skip parsing build/env if neither it nor our environment has changed
+    # since the last run that did not need a restart.
+    import hashlib
+
+    environ = repr(sorted(os.environ.items())).encode("utf-8")
+    stamp = "%d %s" % (
+        os.stat("build/env").st_mtime_ns,
+        hashlib.blake2b(environ, digest_size=8).hexdigest(),
+    )
+    try:
+        with open("build/env.stamp", "r") as f:
+            if f.read() == stamp:
+                return
+    except IOError:
+        pass
+
     with open("build/env", "r") as f:
         env = dict(l.split("=", 1) for l in f.read().splitlines() if "=" in l)
     if all(os.environ.get(k) == v for k, v in env.items()):
         # No restart needed
+        with open("build/env.stamp", "w") as f:
+            f.write(stamp)
         return
     # Restart with new environment
     newenv = os.environ.copy()
@@ -65,8 +89,6 @@ def ensureenv():
 ensureenv()
 
 
-import platform
-
 if sys.version_info[0] >= 3:
     printf = eval("print")
     libdir_escape = "unicode_escape"
@@ -144,6 +166,8 @@ except ImportError:
 # The base IronPython distribution (as of 2.7.1) doesn't support bz2
 isironpython = False
 try:
+    import platform
+
     isironpython = platform.python_implementation().lower().find("ironpython") != -1
 except AttributeError:
     pass
@@ -174,15 +198,25 @@ from distutils.command.install_lib import install_lib
 from distutils.command.install_scripts import install_scripts
 from distutils.core import Command, Extension
 from distutils.core import setup
-from distutils.dir_util import copy_tree
+from distutils.dep_util import newer
 from distutils.dist import Distribution
-from distutils.errors import CCompilerError, DistutilsError, DistutilsExecError
-from distutils.spawn import spawn, find_executable
-from distutils.sysconfig import get_config_var
+from distutils.errors import (
+    CCompilerError,
+    DistutilsError,
+    DistutilsExecError,
+    DistutilsOptionError,
+)
+from distutils.spawn import spawn
+from distutils.sysconfig import customize_compiler, get_config_var
 from distutils.version import StrictVersion
 
 from distutils_rust import RustBinary, BuildRustExt, InstallRustExt
 
+
+# Both scan the filesystem ($PATH, linker paths) on every call.
+find_executable = functools.lru_cache(maxsize=None)(distutils.spawn.find_executable)
+find_library = functools.lru_cache(maxsize=None)(ctypes.util.find_library)
+
 havefb = os.path.exists("fb")
 isgetdepsbuild = os.environ.get("GETDEPS_BUILD") == "1"
 
@@ -194,6 +228,11 @@ STDC99 = "" if iswindows else "-std=c99"
 STDCPP0X = "" if iswindows else "-std=c++0x"
 STDCPP11 = "" if iswindows else "-std=c++11"
 WALL = "/Wall" if iswindows else "-Wall"
+
+# Process pools that cannot fork re-import the main module in each worker,
+# which would run setup() again. Only use them where workers are forked.
+canforkworkers = multiprocessing.get_start_method() == "fork"
+compileworkers = 0 if canforkworkers else 1
 WSTRICTPROTOTYPES = None if iswindows else "-Werror=strict-prototypes"
 
 cflags = []
@@ -218,12 +257,86 @@ def write_if_changed(path, content):
             fh.write(content)
 
 
+def write_if_changed_fast(path, content):
+    """Like write_if_changed, but check a digest recorded in build/ first.
+
+    The digest is stored along with the size and mtime of the file, so the
+    common unchanged case is a stat and a small read instead of reading and
+    comparing the whole file.
+    """
+    name = relpath(os.path.abspath(path), scriptdir).replace(os.sep, "_")
+    sumpath = pjoin(builddir, "sums", name + ".sum")
+    digest = hashlib.blake2b(content, digest_size=16).hexdigest()
+
+    def fingerprint():
+        st = os.stat(path)
+        return "%s %d %d" % (digest, st.st_size, st.st_mtime_ns)
+
+    try:
+        with open(sumpath, "r") as f:
+            if f.read() == fingerprint():
+                return
+    except (IOError, OSError):
+        pass
+    write_if_changed(path, content)
+    ensureexists(os.path.dirname(sumpath))
+    with open(sumpath, "w") as f:
+        f.write(fingerprint())
+
+
 pjoin = os.path.join
 relpath = os.path.relpath
 scriptdir = os.path.realpath(pjoin(__file__, ".."))
 builddir = pjoin(scriptdir, "build")
 
 
+def findcompilercache():
+    """Find a compiler cache (ccache or sccache) to launch compilers with.
+
+    Set HG_DISABLE_CCACHE to opt out, e.g. when debugging the compiler.
+    """
+    if iswindows or os.environ.get("HG_DISABLE_CCACHE"):
+        return None
+    for name in ("ccache", "sccache"):
+        path = find_executable(name)
+        if path:
+            return path
+    return None
+
+
+compilercache = findcompilercache()
+
+if compilercache:
+    # Keep cache keys stable across build directories and compiler upgrades
+    # that do not bump the compiler mtime.
+    os.environ.setdefault("CCACHE_COMPILERCHECK", "content")
+    os.environ.setdefault("CCACHE_BASEDIR", scriptdir)
+    # distutils (customize_compiler) and the Rust "cc" crate both pick up
+    # CC/CXX, so this covers C extensions, libraries like chg, and Rust deps.
+    for name in ("CC", "CXX"):
+        value = os.environ.get(name, get_config_var(name) or "")
+        if value and os.path.basename(value.split()[0]) not in ("ccache", "sccache"):
+            os.environ[name] = "%s %s" % (compilercache, value)
+
+
+def usecompilercache(cc):
+    """Prepend the compiler cache to a compiler created by new_compiler()"""
+    if compilercache:
+        for attr in ("compiler", "compiler_so", "compiler_cxx"):
+            args = getattr(cc, attr, None)
+            if isinstance(args, list) and args and args[0] != compilercache:
+                args.insert(0, compilercache)
+    return cc
+
+
+@functools.lru_cache(maxsize=1)
+def probecompiler():
+    """Shared compiler for feature probes and small helper binaries"""
+    cc = new_compiler()
+    customize_compiler(cc)
+    return usecompilercache(cc)
+
+
 def ensureexists(path):
     if not os.path.exists(path):
         os.makedirs(path)
@@ -249,12 +362,146 @@ def tryunlink(path):
             raise
 
 
+def stalepycs(root, dirs):
+    """Legacy X.pyc files in the given directories under root with no X.py
+
+    Each directory is listed once instead of globbed and stat'ed per file.
+    __pycache__ is not looked at: its pycs carry an interpreter tag and never
+    have a sibling source file.
+    """
+    for reldir in dirs:
+        path = pjoin(root, reldir)
+        try:
+            names = set(os.listdir(path))
+        except OSError:
+            continue
+        for name in sorted(names):
+            if name.endswith(".pyc") and name[:-1] not in names:
+                yield pjoin(path, name)
+
+
+# Python 3.8+ shutil already copies via sendfile on Linux.
+usesendfile = sys.platform.startswith("linux") and not getattr(
+    shutil, "_USE_CP_SENDFILE", False
+)
+
+
+# ioctl request number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+
+def reflink(source, target):
+    """Try to clone source to target on a copy-on-write filesystem
+
+    Supported by Btrfs and XFS on Linux, and APFS on macOS. Return False
+    if the data has to be copied instead.
+    """
+    if sys.platform.startswith("linux"):
+        import fcntl
+
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except (IOError, OSError):
+            return False
+    elif sys.platform == "darwin":
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "clonefile"):
+            return False
+        # clonefile refuses to replace an existing target
+        tryunlink(target)
+        return libc.clonefile(os.fsencode(source), os.fsencode(target), 0) == 0
+    return False
+
+
+def copyfile(source, target):
+    """Like shutil.copy2, but let the kernel copy the data where possible"""
+    if reflink(source, target):
+        shutil.copystat(source, target)
+        return target
+    if not usesendfile:
+        return shutil.copy2(source, target)
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    shutil.copystat(source, target)
+    return target
+
+
+copybuffers = threading.local()
+
+
+def copyfileobj(source, target):
+    """Like shutil.copyfileobj, but reuse one buffer per thread"""
+    buf = getattr(copybuffers, "buf", None)
+    if buf is None:
+        buf = copybuffers.buf = memoryview(bytearray(1 << 20))
+    while True:
+        n = source.readinto(buf)
+        if not n:
+            break
+        target.write(buf[:n])
+
+
+def compilepyc(sourcepath):
+    """Read a .py file and compile it to .pyc content in memory
+
+    Returns (source, pyc). pyc is None if the source does not compile.
+    """
+    import importlib._bootstrap_external
+
+    with open(sourcepath, "rb") as f:
+        source = f.read()
+    try:
+        code = compile(source, sourcepath, "exec", dont_inherit=True)
+    except SyntaxError as ex:
+        log.warn("cannot compile %s: %s" % (sourcepath, ex))
+        return source, None
+    mtime = int(os.stat(sourcepath).st_mtime)
+    pyc = importlib._bootstrap_external._code_to_timestamp_pyc(code, mtime, len(source))
+    return source, bytes(pyc)
+
+
 def copy_to(source, target):
     if os.path.isdir(source):
-        copy_tree(source, target)
+        # Like distutils copy_tree, symlinks are followed and existing files
+        # are replaced, but each file goes through copyfile.
+        for root, _dirs, files in os.walk(source, followlinks=True):
+            destdir = pjoin(target, relpath(root, source))
+            ensureexists(destdir)
+            for name in files:
+                copyfile(pjoin(root, name), pjoin(destdir, name))
     else:
         ensureexists(os.path.dirname(target))
-        shutil.copy2(source, target)
+        copyfile(source, target)
+
+
+def safe_extract(tar, path):
+    """Extract a tarfile, refusing members that would land outside path.
+
+    Members are validated while extractall consumes them, so the archive
+    is only traversed once and can be opened in streaming mode. Returns
+    the names of the extracted members.
+    """
+    abspath = os.path.abspath(path)
+    names = []
+
+    def checkedmembers():
+        for member in tar:
+            target = os.path.abspath(os.path.join(path, member.name))
+            if os.path.commonprefix([abspath, target]) != abspath:
+                raise Exception("Attempted Path Traversal in Tar File")
+            names.append(member.name)
+            yield member
+
+    tar.extractall(path, checkedmembers())
+    return names
 
 
 def rmtree(path):
@@ -287,11 +534,66 @@ def chdir(nwd):
 
 # Rename hg to $HGNAME. Useful when "hg" is a wrapper calling $HGNAME (or chg).
 hgname = os.environ.get("HGNAME", "hg")
-if not re.match("\Ahg[.0-9a-z-]*\Z", hgname):
+hgnamere = re.compile(r"\Ahg[.0-9a-z-]*\Z")
+if not hgnamere.match(hgname):
     raise RuntimeError("Illegal HGNAME: %s" % hgname)
 
 
-def cancompile(cc, code):
+probecachepath = pjoin(builddir, "configcache.json")
+probecache = None
+
+
+def loadprobecache():
+    global probecache
+    if probecache is None:
+        try:
+            with open(probecachepath, "r") as f:
+                probecache = json.load(f)
+        except Exception:
+            probecache = {}
+        atexit.register(saveprobecache)
+    return probecache
+
+
+def saveprobecache():
+    if probecache and os.path.isdir(builddir):
+        write_if_changed(
+            probecachepath, json.dumps(probecache, sort_keys=True).encode("utf-8")
+        )
+
+
+def probecachekey(cc, code, extraargs=()):
+    """Key a compile probe by the compiler binary, its flags and the source"""
+    args = getattr(cc, "compiler_so", None) or []
+    args = [a for a in args if a != compilercache]
+    if not args:
+        return None
+    compiler = find_executable(args[0]) or args[0]
+    mtimes = []
+    # Kernel headers (sys/fanotify.h et al.) are upgraded with version.h.
+    for path in (compiler, "/usr/include/linux/version.h"):
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    key = repr((compiler, mtimes, args, cflags, code, list(extraargs)))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def cancompile(cc, code, extraargs=()):
+    """Test if code compiles and links. Results are cached in build/."""
+    key = probecachekey(cc, code, extraargs)
+    cache = loadprobecache()
+    if key in cache:
+        return cache[key]
+    result = _cancompile(cc, code, extraargs)
+    if key is not None:
+        cache[key] = result
+    return result
+
+
+def _cancompile(cc, code, extraargs=()):
+    usecompilercache(cc)
     tmpdir = tempfile.mkdtemp(prefix="hg-install-")
     devnull = oldstderr = None
     try:
@@ -306,8 +608,12 @@ def cancompile(cc, code):
         devnull = open("/dev/null", "w")
         oldstderr = os.dup(sys.stderr.fileno())
         os.dup2(devnull.fileno(), sys.stderr.fileno())
-        objects = cc.compile([fname], output_dir=tmpdir)
-        cc.link_executable(objects, os.path.join(tmpdir, "a.out"))
+        objects = cc.compile(
+            [fname], output_dir=tmpdir, extra_postargs=list(extraargs)
+        )
+        cc.link_executable(
+            objects, os.path.join(tmpdir, "a.out"), extra_postargs=list(extraargs)
+        )
         return True
     except Exception:
         return False
@@ -332,9 +638,8 @@ def hasheader(cc, headername):
 
 
 def runcmd(cmd, env):
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
-    out, err = p.communicate()
-    return p.returncode, out, err
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    return p.returncode, p.stdout, p.stderr
 
 
 class hgcommand(object):
@@ -349,26 +654,25 @@ class hgcommand(object):
         if err or returncode != 0:
             printf("stderr from '%s':" % (" ".join(cmd)), file=sys.stderr)
             printf(err, file=sys.stderr)
-            return ""
+            return b""
         return out
 
 
+# If root is executing setup.py, but the repository is owned by
+# another user (as in "sudo python setup.py install") we will get
+# trust warnings since the .hg/hgrc file is untrusted. That is
+# fine, we don't want to load it anyway.  Python may warn about
+# a missing __init__.py in mercurial/locale, we also ignore that.
+hgerrignorere = re.compile(
+    b"not trusting file"
+    b"|warning: Not importing"
+    b"|obsolete feature not enabled"
+    b"|devel-warn:"
+)
+
+
 def filterhgerr(err):
-    # If root is executing setup.py, but the repository is owned by
-    # another user (as in "sudo python setup.py install") we will get
-    # trust warnings since the .hg/hgrc file is untrusted. That is
-    # fine, we don't want to load it anyway.  Python may warn about
-    # a missing __init__.py in mercurial/locale, we also ignore that.
-    err = [
-        e
-        for e in err.splitlines()
-        if (
-            not e.startswith(b"not trusting file")
-            and not e.startswith(b"warning: Not importing")
-            and not e.startswith(b"obsolete feature not enabled")
-            and not e.startswith(b"devel-warn:")
-        )
-    ]
+    err = [e for e in err.splitlines() if not hgerrignorere.match(e)]
     return b"\n".join(b"  " + e for e in err)
 
 
@@ -434,13 +738,84 @@ def localhgenv():
     return env
 
 
-hg = findhg()
+_hg = []
+
+
+def gethg():
+    """Memoized findhg(). hg is only probed if a template is not cached."""
+    if not _hg:
+        _hg.append(findhg())
+    return _hg[0]
+
+
+hgtemplatecachepath = pjoin(builddir, "hgversion.json")
+
+
+def dirstatemtime():
+    """Return the mtime of .hg/dirstate of the repo containing the current
+    directory, or None if it cannot be found.
+
+    The dirstate is rewritten whenever the working copy parent changes, so
+    it can be used to invalidate "hg log -r." results.
+    """
+    path = os.getcwd()
+    while True:
+        dirstate = pjoin(path, ".hg", "dirstate")
+        if os.path.exists(dirstate):
+            return os.path.getmtime(dirstate)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def hgtemplates(*templates):
+    """Evaluate templates against the working copy parent.
+
+    Cached results are reused while the dirstate is unchanged. All other
+    templates are evaluated by a single "hg log" invocation, or one per
+    template if its output cannot be split apart. Returns a list
+    of strings, with None for templates that could not be evaluated.
+    """
+    mtime = dirstatemtime()
+    try:
+        with open(hgtemplatecachepath, "r") as f:
+            cache = json.load(f)
+    except Exception:
+        cache = {}
+    results = {}
+    for template in templates:
+        cached = cache.get(template)
+        if mtime is not None and cached and cached[0] == mtime:
+            results[template] = cached[1]
+
+    missing = [t for t in templates if t not in results]
+    hg = gethg() if missing else None
+    if hg:
+        # Separate outputs with NUL, which the templates never produce.
+        out = hg.run(["log", "-r.", "-T", "\\0".join(missing)])
+        if len(missing) == 1:
+            outs = [sysstr(out)]
+        else:
+            outs = sysstr(out).split("\0") if out else []
+        if len(outs) != len(missing):
+            # Extra output, a NUL in a result or a failing template. Evaluate
+            # them one at a time so one bad template cannot blank the others.
+            outs = [sysstr(hg.run(["log", "-r.", "-T", t])) for t in missing]
+        results.update(zip(missing, outs))
+        if mtime is not None and os.path.isdir(builddir):
+            for template, result in zip(missing, outs):
+                if result:
+                    cache[template] = [mtime, result]
+            write_if_changed(
+                hgtemplatecachepath,
+                json.dumps(cache, sort_keys=True).encode("utf-8"),
+            )
+    return [results.get(t) for t in templates]
 
 
 def hgtemplate(template, cast=None):
-    if not hg:
-        return None
-    result = sysstr(hg.run(["log", "-r.", "-T", template]))
+    result = hgtemplates(template)[0]
     if result and cast:
         result = cast(result)
     return result
@@ -490,26 +865,26 @@ versionhash = struct.unpack(">Q", hashlib.sha1(versionb).digest()[:8])[0]
 
 chgcflags = ["-std=c99", "-D_GNU_SOURCE", "-DHAVE_VERSIONHASH", "-I%s" % builddir]
 versionhashpath = pjoin(builddir, "versionhash.h")
-write_if_changed(versionhashpath, "#define HGVERSIONHASH %sULL\n" % versionhash)
+write_if_changed_fast(versionhashpath, b"#define HGVERSIONHASH %dULL\n" % versionhash)
 
-write_if_changed(
+write_if_changed_fast(
     "edenscm/mercurial/__version__.py",
     b"".join(
         [
             b"# this file is autogenerated by setup.py\n"
             b'version = "%s"\n' % versionb,
-            b"versionhash = %s\n" % versionhash,
+            b"versionhash = %d\n" % versionhash,
         ]
     ),
 )
 
-write_if_changed(
+write_if_changed_fast(
     "lib/version/src/version.rs",
     b"".join(
         [
             b"// this file is autogenerated by setup.py\n"
             b'pub static VERSION: &\'static str = "%s";\n' % versionb,
-            b"pub static VERSION_HASH: u64 = %s;\n" % versionhash,
+            b"pub static VERSION_HASH: u64 = %d;\n" % versionhash,
         ]
     ),
 )
@@ -517,8 +892,13 @@ write_if_changed(
 
 def writebuildinfoc():
     """Write build/buildinfo.c"""
-    commithash = hgtemplate("{node}")
-    commitunixtime = hgtemplate('{sub("[^0-9].*","",date)}', cast=int)
+    commithash, commitunixtime = hgtemplates(
+        "{node}", '{sub("[^0-9].*","",date)}'
+    )
+    if commitunixtime:
+        commitunixtime = int(commitunixtime)
+
+    import socket
 
     # Search 'extractBuildInfoFromELF' in fbcode for supported fields.
     buildinfo = {
@@ -539,39 +919,35 @@ def writebuildinfoc():
         "User": os.environ.get("USER"),
     }
 
-    buildinfosrc = """
-#include <stdio.h>
-#include <time.h>
-"""
+    lines = ["", "#include <stdio.h>", "#include <time.h>"]
     for name, value in sorted(buildinfo.items()):
         if isinstance(value, str):
-            buildinfosrc += 'const char *BuildInfo_k%s = "%s";\n' % (
-                name,
-                value.replace('"', '\\"'),
+            lines.append(
+                'const char *BuildInfo_k%s = "%s";' % (name, value.replace('"', '\\"'))
             )
         elif isinstance(value, int):
             # The only usage of int is timestamp
-            buildinfosrc += "const time_t BuildInfo_k%s = %d;\n" % (name, value)
+            lines.append("const time_t BuildInfo_k%s = %d;" % (name, value))
 
-    buildinfosrc += """
-/* This function keeps references of the symbols and prevents them from being
- * optimized out if this function is used. */
-void print_buildinfo() {
-"""
+    lines += [
+        "",
+        "/* This function keeps references of the symbols and prevents them from being",
+        " * optimized out if this function is used. */",
+        "void print_buildinfo() {",
+    ]
     for name, value in sorted(buildinfo.items()):
         if isinstance(value, str):
-            buildinfosrc += (
-                '  fprintf(stderr, "%(name)s: %%s (at %%p)\\n", BuildInfo_k%(name)s, BuildInfo_k%(name)s);\n'
+            lines.append(
+                '  fprintf(stderr, "%(name)s: %%s (at %%p)\\n", BuildInfo_k%(name)s, BuildInfo_k%(name)s);'
                 % {"name": name}
             )
         elif isinstance(value, int):
-            buildinfosrc += (
-                '  fprintf(stderr, "%(name)s: %%lu (at %%p)\\n", (long unsigned)BuildInfo_k%(name)s, &BuildInfo_k%(name)s) ;\n'
+            lines.append(
+                '  fprintf(stderr, "%(name)s: %%lu (at %%p)\\n", (long unsigned)BuildInfo_k%(name)s, &BuildInfo_k%(name)s) ;'
                 % {"name": name}
             )
-    buildinfosrc += """
-}
-"""
+    lines += ["", "}", ""]
+    buildinfosrc = "\n".join(lines)
 
     path = pjoin(builddir, "buildinfo.c")
     write_if_changed(path, buildinfosrc.encode("utf-8"))
@@ -594,6 +970,58 @@ except ImportError:
     version = "unknown"
 
 
+assetlocks = {}
+
+
+def urlmetadata(url, response):
+    """Metadata identifying the content served for url"""
+    headers = response.headers
+    return {
+        "url": hashlib.sha256(url.encode("utf-8")).hexdigest(),
+        "etag": headers.get("ETag"),
+        "last-modified": headers.get("Last-Modified"),
+        "content-length": headers.get("Content-Length"),
+    }
+
+
+def urldownload(url, destpath):
+    """Download url to destpath, following redirects.
+
+    The response metadata is recorded in destpath.meta.json. If destpath
+    was downloaded before and a HEAD request reports the same metadata,
+    the download is skipped.
+    """
+    from urllib.request import Request, urlopen
+
+    metapath = destpath + ".meta.json"
+    if os.path.exists(destpath):
+        try:
+            with open(metapath, "r") as f:
+                cached = json.load(f)
+            with urlopen(Request(url, method="HEAD")) as response:
+                current = urlmetadata(url, response)
+            validated = current["etag"] or current["last-modified"]
+            size = current["content-length"]
+            if (
+                validated
+                and cached == current
+                and (size is None or int(size) == os.path.getsize(destpath))
+            ):
+                return
+        except Exception:
+            pass
+
+    # Drop stale metadata first so an interrupted download is not trusted.
+    tryunlink(metapath)
+    with urlopen(url) as response, open(destpath, "wb") as f:
+        copyfileobj(response, f)
+        meta = urlmetadata(url, response)
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(destpath))
+    with os.fdopen(fd, "w") as f:
+        json.dump(meta, f, sort_keys=True)
+    os.replace(tmppath, metapath)
+
+
 class asset(object):
     def __init__(self, name=None, url=None, destdir=None, version=0):
         """Declare an asset to download
@@ -625,67 +1053,87 @@ class asset(object):
         self.url = url
         self.destdir = destdir
         self.version = version
+        self._srcpath = pjoin(builddir, name)
+        self._readypath = pjoin(builddir, destdir, ".ready")
 
     def ensureready(self):
         """Download and extract the asset to self.destdir. Return full path of
         the directory containing extracted files.
         """
-        if not self._isready():
-            self._download()
-            self._extract()
-            self._markready()
+        with self._lock():
+            if not self._isready():
+                self._download()
+                self._extract()
+                self._markready()
         assert self._isready(), "%r should be ready now" % self
         return pjoin(builddir, self.destdir)
 
+    @classmethod
+    def ensureallready(cls, assets, workers=16):
+        """Like ensureready, but download missing assets concurrently.
+
+        Downloads are network bound and independent. Extraction is disk
+        bound and runs serially to avoid thrashing.
+        """
+        pending = [a for a in assets if not a._isready()]
+        if pending:
+            workers = min(workers, len(pending))
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                list(executor.map(lambda a: a._download(), pending))
+            for a in pending:
+                with a._lock():
+                    if not a._isready():
+                        a._extract()
+                        a._markready()
+        for a in assets:
+            assert a._isready(), "%r should be ready now" % a
+
+    def _lock(self):
+        """Lock guarding extraction into self.destdir across threads"""
+        # dict.setdefault is atomic, so concurrent callers get the same lock.
+        return assetlocks.setdefault(self.destdir, threading.Lock())
+
     def _download(self):
-        destpath = pjoin(builddir, self.name)
+        destpath = self._srcpath
         if havefb:
             # via internal LFS utlity
             lfspypath = os.environ.get(
                 "LFSPY_PATH", pjoin(scriptdir, "../../tools/lfs/lfs.py")
             )
             args = [sys.executable, lfspypath, "-q", "download", destpath]
+            subprocess.check_call(args)
         else:
             # via external URL
             assert self.url, "Cannot download %s - no URL provided" % self.name
-            args = ["curl", "-L", self.url, "-o", destpath]
-        subprocess.check_call(args)
+            urldownload(self.url, destpath)
 
     def _extract(self):
         destdir = self.destdir
-        srcpath = pjoin(builddir, self.name)
+        srcpath = self._srcpath
         destpath = pjoin(builddir, destdir)
         assert os.path.isfile(srcpath), "%s is not downloaded properly" % srcpath
         ensureempty(destpath)
 
         if srcpath.endswith(".tar.gz"):
-            with tarfile.open(srcpath, "r") as f:
-                # Be smarter: are all paths in the tar already starts with
-                # destdir? If so, strip it.
-                prefix = destdir + "/"
-                if all((name + "/").startswith(prefix) for name in f.getnames()):
-                    destpath = os.path.dirname(destpath)
-                def is_within_directory(directory, target):
-                    
-                    abs_directory = os.path.abspath(directory)
-                    abs_target = os.path.abspath(target)
-                
-                    prefix = os.path.commonprefix([abs_directory, abs_target])
-                    
-                    return prefix == abs_directory
-                
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception("Attempted Path Traversal in Tar File")
-                
-                    tar.extractall(path, members, numeric_owner=numeric_owner) 
-                    
-                
-                safe_extract(f, destpath)
+            import tarfile
+
+            # Streaming mode decompresses the archive once, instead of once
+            # for getnames() and again for the seek back to extract.
+            with tarfile.open(srcpath, "r|gz") as f:
+                names = safe_extract(f, destpath)
+            # Be smarter: are all paths in the tar already starts with
+            # destdir? If so, strip it.
+            prefix = destdir + "/"
+            if names and all((name + "/").startswith(prefix) for name in names):
+                strippath = destpath + ".strip"
+                if os.path.exists(strippath):
+                    rmtree(strippath)
+                os.rename(destpath, strippath)
+                os.rename(pjoin(strippath, destdir), destpath)
+                rmtree(strippath)
         elif srcpath.endswith(".zip") or srcpath.endswith(".whl"):
+            import zipfile
+
             with zipfile.ZipFile(srcpath, "r") as f:
                 # Same as above. Strip the destdir name if all entries have it.
                 prefix = destdir + "/"
@@ -696,7 +1144,10 @@ class asset(object):
             raise RuntimeError("don't know how to extract %s" % self.name)
 
     def __hash__(self):
-        return hash((self.name, self.url, self.version))
+        # Not hash() of the tuple: str hashes are randomized per process on
+        # Python 3, which would invalidate .ready on every run.
+        key = repr((self.name, self.url, self.version)).encode("utf-8")
+        return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big")
 
     def _isready(self):
         try:
@@ -709,10 +1160,6 @@ class asset(object):
         with open(self._readypath, "w") as f:
             f.write("%s" % hash(self))
 
-    @property
-    def _readypath(self):
-        return pjoin(builddir, self.destdir, ".ready")
-
 
 class fbsourcepylibrary(asset):
     """An asset available from inside fbsource only.
@@ -747,11 +1194,20 @@ class fbsourcepylibrary(asset):
         destpath = pjoin(topdir, self.pkgname)
         if os.path.exists(destpath):
             shutil.rmtree(destpath)
-        shutil.copytree(self.path, destpath)
-        for root, dirs, files in os.walk(topdir):
-            if "__init__.py" not in files:
-                with open(pjoin(root, "__init__.py"), "w") as f:
+        shutil.copytree(self.path, destpath, copy_function=copyfile)
+
+        def addinitpy(path):
+            # scandir reuses the dirent type, unlike os.walk's extra stats
+            with os.scandir(path) as it:
+                entries = list(it)
+            if not any(e.name == "__init__.py" for e in entries):
+                with open(pjoin(path, "__init__.py"), "w") as f:
                     f.write("\n")
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    addinitpy(entry.path)
+
+        addinitpy(topdir)
         for name in self.excludes:
             tryunlink(pjoin(topdir, name))
 
@@ -762,18 +1218,22 @@ class edenpythrift(asset):
 
     def _extract(self):
         destdir = self.destdir
-        srcpath = pjoin(builddir, self.name)
+        srcpath = self._srcpath
         destpath = pjoin(builddir, destdir)
         assert os.path.isfile(srcpath), "%s is not downloaded properly" % srcpath
         ensureempty(destpath)
 
+        import zipfile
+
         with zipfile.ZipFile(srcpath, "r") as f:
-            for name in f.namelist():
-                if name.startswith("py/"):
-                    targetname = name[3:]  # strip off `py/` prefix
-                    ensureexists(os.path.dirname(pjoin(destpath, targetname)))
-                    with open(pjoin(destpath, targetname), "wb") as target:
-                        target.write(f.read(name))
+            names = [name for name in f.namelist() if name.startswith("py/")]
+            for name in names:
+                targetname = name[3:]  # strip off `py/` prefix
+                ensureexists(os.path.dirname(pjoin(destpath, targetname)))
+                with f.open(name) as source, open(
+                    pjoin(destpath, targetname), "wb"
+                ) as target:
+                    copyfileobj(source, target)
 
 
 class thriftasset(asset):
@@ -789,36 +1249,43 @@ class thriftasset(asset):
 
     def _download(self):
         for source, dest in self.sourcemap.items():
-            copy_to(pjoin(scriptdir, source), pjoin(builddir, self.name, dest))
+            copy_to(pjoin(scriptdir, source), pjoin(self._srcpath, dest))
 
     def _extract(self):
-        thriftdir = pjoin(builddir, self.name)
+        thriftdir = self._srcpath
         destdir = pjoin(builddir, self.destdir)
-        for thriftdest in self.sourcemap.values():
-            thriftfile = pjoin(thriftdir, thriftdest)
-            subprocess.check_call(
-                [
-                    os.environ["THRIFT"],
-                    "-I",
-                    thriftdir,
-                    "-gen",
-                    "py:new_style",
-                    "-out",
-                    destdir,
-                    thriftfile,
-                ]
-            )
+        cmds = [
+            [
+                os.environ["THRIFT"],
+                "-I",
+                thriftdir,
+                "-gen",
+                "py:new_style",
+                "-out",
+                destdir,
+                pjoin(thriftdir, thriftdest),
+            ]
+            for thriftdest in self.sourcemap.values()
+        ]
+        # Each thrift invocation is independent, so run them concurrently.
+        # map() re-raises the first CalledProcessError, in command order.
+        with concurrent.futures.ThreadPoolExecutor(min(8, len(cmds))) as executor:
+            list(executor.map(subprocess.check_call, cmds))
 
     def __hash__(self):
-        thriftdir = pjoin(builddir, self.name)
-        hasher = hashlib.sha1()
+        thriftdir = self._srcpath
+        hasher = hashlib.blake2b(digest_size=8)
 
         for thriftdest in sorted(self.sourcemap.values()):
             thriftfile = pjoin(thriftdir, thriftdest)
             if os.path.exists(thriftfile):
-                with open(thriftfile) as f:
-                    hasher.update(f.read())
-        return int(hasher.hexdigest(), 16)
+                with open(thriftfile, "rb") as f:
+                    # mmap cannot map empty files
+                    if os.fstat(f.fileno()).st_size == 0:
+                        continue
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        hasher.update(mm)
+        return int.from_bytes(hasher.digest(), "big")
 
 
 class fetchbuilddeps(Command):
@@ -921,9 +1388,30 @@ class fetchbuilddeps(Command):
     def finalize_options(self):
         pass
 
+    def _stamp(self):
+        """Fingerprint of the assets and the state of their directories"""
+        assets = {}
+        for a in self.assets:
+            try:
+                mtime = os.stat(pjoin(builddir, a.destdir)).st_mtime
+            except OSError:
+                mtime = None
+            assets[a.destdir] = [hash(a), mtime]
+        # A newer setup.py may declare different assets.
+        return {"setup.py": os.stat(__file__).st_mtime, "assets": assets}
+
     def run(self):
-        for item in self.assets:
-            item.ensureready()
+        # Skip checking every asset if nothing changed since the last run.
+        stamppath = pjoin(builddir, ".deps.stamp")
+        try:
+            with open(stamppath, "r") as f:
+                uptodate = json.load(f) == self._stamp()
+        except Exception:
+            uptodate = False
+        if not uptodate:
+            asset.ensureallready(self.assets)
+            with open(stamppath, "w") as f:
+                json.dump(self._stamp(), f, sort_keys=True)
         if iswindows:
             # See https://docs.rs/openssl/0.10.18/openssl/
             os.environ["OPENSSL_DIR"] = pjoin(builddir, self.opensslwinasset.destdir)
@@ -954,6 +1442,7 @@ class hgbuildmo(build):
             return
 
         join = os.path.join
+        cmds = []
         for po in os.listdir(podir):
             if not po.endswith(".po"):
                 continue
@@ -961,22 +1450,59 @@ class hgbuildmo(build):
             modir = join("locale", po[:-3], "LC_MESSAGES")
             mofile = join(modir, "hg.mo")
             mobuildfile = join("edenscm/mercurial", mofile)
+            if not (self.force or newer(pofile, mobuildfile)):
+                log.debug("skipping %s (up-to-date)", mobuildfile)
+                continue
             cmd = ["msgfmt", "-v", "-o", mobuildfile, pofile]
             if sys.platform != "sunos5":
                 # msgfmt on Solaris does not know about -c
                 cmd.append("-c")
             self.mkpath(join("edenscm/mercurial", modir))
-            self.make_file([pofile], mobuildfile, spawn, (cmd,))
+            cmds.append(cmd)
+
+        if not cmds:
+            return
+        # Each msgfmt is an independent process. Run them concurrently.
+        workers = min(32, (os.cpu_count() or 1) * 2, len(cmds))
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(lambda cmd: spawn(cmd, dry_run=self.dry_run), cmds))
 
 
 class hgdist(Distribution):
     pure = False
     cffi = ispypy
+    pgo = None
+    lto = False
 
     global_options = Distribution.global_options + [
-        ("pure", None, "use pure (slow) Python " "code instead of C extensions")
+        ("pure", None, "use pure (slow) Python " "code instead of C extensions"),
+        (
+            "pgo=",
+            None,
+            "profile-guided optimization of the C libraries: 'generate' builds "
+            "instrumented libraries, 'use' rebuilds them with the profile",
+        ),
+        ("lto", None, "use link-time optimization for the C libraries"),
     ]
 
+    def parse_command_line(self):
+        result = Distribution.parse_command_line(self)
+        if self.pgo is None:
+            # lets CI drive both PGO stages without changing the command line
+            self.pgo = os.environ.get("HG_PGO_PHASE") or None
+        if self.pgo not in (None, "generate", "use"):
+            raise DistutilsOptionError(
+                "--pgo and HG_PGO_PHASE must be 'generate' or 'use'"
+            )
+        if self.pgo == "generate" and not iswindows:
+            # The compiler driver only links the profiling runtime that the
+            # instrumented chg needs if it sees the flag when linking hgmain.
+            rustflags = os.environ.get("RUSTFLAGS", "")
+            os.environ["RUSTFLAGS"] = (
+                rustflags + " -C link-arg=-fprofile-generate"
+            ).strip()
+        return result
+
     def has_ext_modules(self):
         # self.ext_modules is emptied in hgbuildpy.finalize_options which is
         # too late for some cases
@@ -1004,7 +1530,7 @@ class hgbuildext(build_ext):
 class hgbuildscripts(build_scripts):
     def run(self):
         if havefanotify:
-            cc = new_compiler()
+            cc = probecompiler()
             objs = cc.compile(glob.glob("contrib/whochanges/*.c"), debug=True)
             dest = os.path.join(self.build_dir, "whochanges")
             cc.link_executable(objs, dest)
@@ -1053,23 +1579,34 @@ class buildembedded(Command):
         copy_to(pjoin(parentdir, "edenscm"), pjoin(dirforexts, "edenscm"))
 
     def _zip_pyc_files(self, embdir, zipname):
-        """Modify a zip archive to include edenscm .pyc files"""
+        """Modify a zip archive to include edenscm .py and .pyc files"""
+        import zipfile
+
         sourcedir = pjoin(embdir, "edenscm")
-        with zipfile.PyZipFile(zipname, "a") as z:
-            z.debug = 1
-            # Write .py files for better traceback.
-            for root, _dirs, files in os.walk(sourcedir):
-                for basename in files:
-                    sourcepath = pjoin(root, basename)
-                    if sourcepath.endswith(".py"):
-                        # relative to scriptdir
-                        inzippath = sourcepath[len(scriptdir) + 1 :]
-                        z.write(sourcepath, inzippath)
-
-                        # Remove the pyc to force recompiling them
-                        tryunlink(sourcepath + "c")
-            # Compile and write .pyc files.
-            z.writepy(sourcedir)
+        sourcepaths = []
+        for root, _dirs, files in os.walk(sourcedir):
+            sourcepaths += [pjoin(root, f) for f in sorted(files) if f.endswith(".py")]
+
+        # Compile in memory so each source is read once and no .pyc files
+        # are written next to it. zipimport only looks for .pyc files next to
+        # the sources, and compares their mtime with the .py entry's.
+        # compilepyc is sent to the workers by name, which fails when a build
+        # frontend execs setup.py without registering it as a module.
+        picklable = getattr(sys.modules.get(__name__), "compilepyc", None)
+        if canforkworkers and picklable is compilepyc:
+            pool = concurrent.futures.ProcessPoolExecutor()
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(1)
+        with pool, zipfile.ZipFile(zipname, "a", zipfile.ZIP_STORED) as z:
+            compiled = pool.map(compilepyc, sourcepaths, chunksize=64)
+            for sourcepath, (source, pyc) in zip(sourcepaths, compiled):
+                inzippath = relpath(sourcepath, embdir).replace(os.sep, "/")
+                # Write .py files for better traceback.
+                info = zipfile.ZipInfo.from_file(sourcepath, inzippath)
+                z.writestr(info, source)
+                if pyc is not None:
+                    info = zipfile.ZipInfo.from_file(sourcepath, inzippath + "c")
+                    z.writestr(info, pyc)
         # Finally, remove the edenscm directory so that the package loads the
         # pyc from the zip.
         rmtree(sourcedir)
@@ -1082,7 +1619,7 @@ class buildembedded(Command):
         pylibpath = os.path.realpath(pjoin(sys.executable, "..", pylibext))
         if not os.path.exists(pylibpath):
             # a fallback option
-            pylibpath = ctypes.util.find_library(pylib)
+            pylibpath = find_library(pylib)
         log.debug("Python dynamic library is copied from: %s" % pylibpath)
         copy_to(pylibpath, pjoin(dirtocopy, os.path.basename(pylibpath)))
         # Copy python27.zip
@@ -1124,19 +1661,46 @@ class buildembedded(Command):
         embdir = pjoin(scriptdir, "build", "embedded")
         ensureempty(embdir)
         ensureexists(embdir)
-        self._process_hg_exts(embdir)
+        zippath = pjoin(embdir, "python27.zip")
 
-        # On Windows, Python shared library has to live at the same level
-        # as the main project binary, since this is the location which
-        # has the first priority in dynamic linker search path.
-        self._copy_py_lib(embdir)
+        # Copying is I/O bound, and independent of the dependency zip until
+        # _zip_pyc_files needs edenscm/. Overlap it with building the zip.
+        copysteps = (self._process_hg_exts, self._copy_hg_exe, self._copy_other)
+        if canforkworkers:
+            # buildpyzip forks compile workers, and forking while other
+            # threads exist is unsafe. Copy from a child process instead,
+            # forked before the zip build starts, while no other threads exist.
+            copier = multiprocessing.get_context("fork").Process(
+                target=lambda: [step(embdir) for step in copysteps]
+            )
+            copier.start()
+        else:
+            # compile steps run in-process here, so threads are fine
+            pool = concurrent.futures.ThreadPoolExecutor(len(copysteps))
+            copies = [pool.submit(step, embdir) for step in copysteps]
 
-        # Build everything into python27.zip, which is in the default sys.path.
-        zippath = pjoin(embdir, "python27.zip")
-        buildpyzip(self.distribution).run(appendzippath=zippath)
+        try:
+            # On Windows, Python shared library has to live at the same level
+            # as the main project binary, since this is the location which
+            # has the first priority in dynamic linker search path.
+            # This also copies python27.zip, so it has to precede buildpyzip.
+            self._copy_py_lib(embdir)
+
+            # Build everything into python27.zip, which is in the default
+            # sys.path.
+            buildpyzip(self.distribution).run(appendzippath=zippath)
+        finally:
+            if canforkworkers:
+                copier.join()
+            else:
+                pool.shutdown()
+        if canforkworkers:
+            if copier.exitcode:
+                raise DistutilsExecError("copying files into %s failed" % embdir)
+        else:
+            for copy in copies:
+                copy.result()
         self._zip_pyc_files(embdir, zippath)
-        self._copy_hg_exe(embdir)
-        self._copy_other(embdir)
 
 
 class hgbuildpy(build_py):
@@ -1166,17 +1730,31 @@ class hgbuildpy(build_py):
         build_py.run(self)
 
         # Find and delete stale pyc files
-        for package in packages:
-            path = pjoin(self.build_lib, package.replace(".", "/"))
-            for pycpath in glob.glob(pjoin(path, "*.pyc")):
-                pypath = pycpath[:-1]
-                if not os.path.exists(pypath):
-                    self.warn("removing stale %s" % pycpath)
-                    tryunlink(pycpath)
+        pkgdirs = [path for _package, path in packagepaths]
+        for pycpath in stalepycs(self.build_lib, pkgdirs):
+            self.warn("removing stale %s" % pycpath)
+            tryunlink(pycpath)
 
         buildpyzip(self.distribution).run()
 
 
+def maxmtime(root):
+    """Newest mtime of root and everything below it
+
+    scandir returns the file type with each entry, so only the stat
+    calls for the mtimes themselves are needed.
+    """
+    result = os.stat(root).st_mtime
+    stack = [root]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            # Directory mtimes catch deleted and renamed entries.
+            result = max(result, entry.stat(follow_symlinks=False).st_mtime)
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+    return result
+
+
 class buildpyzip(Command):
     description = "generate zip for bundled dependent Python modules (ex. IPython)"
     user_options = [
@@ -1215,7 +1793,8 @@ class buildpyzip(Command):
             zippath = appendzippath
         # Perform a mtime check so we can skip building if possible
         if os.path.exists(zippath):
-            depmtime = max(os.stat(d).st_mtime for d in depdirs)
+            # A directory mtime alone misses edits to files inside it.
+            depmtime = max(maxmtime(d) for d in depdirs)
             zipmtime = os.stat(zippath).st_mtime
             if zipmtime > depmtime:
                 return
@@ -1232,7 +1811,30 @@ class buildpyzip(Command):
             )
         )
         tryunlink(pjoin(builddir, "pexpect-4.6.0-py2.py3-none-any/pexpect/_async.py"))
-        with zipfile.PyZipFile(zippath, "a") as f:
+
+        import compileall
+        import zipfile
+
+        # Byte-compile all dependencies using all CPUs. writepy picks up the
+        # up-to-date __pycache__ files instead of compiling serially itself.
+        # Errors are reported by writepy, which adds the source instead.
+        for d in depdirs:
+            compileall.compile_dir(d, quiet=2, workers=compileworkers)
+
+        # writepy decides which files go in, in directory listing order.
+        # Collect its choices first, then write them once in sorted order so
+        # the zip layout is reproducible.
+        entries = {}
+
+        class collectingpyzipfile(zipfile.PyZipFile):
+            def write(self, filename, arcname=None, *args, **kwargs):
+                # Like zipfile, a later duplicate wins.
+                entries[arcname or os.path.basename(filename)] = filename
+
+        with zipfile.PyZipFile(zippath, "a", zipfile.ZIP_DEFLATED) as f:
+            # PyZipFile does not take compresslevel, but write() honors it.
+            f.compresslevel = 1
+            collector = collectingpyzipfile(io.BytesIO(), "w")
             for asset in fetchbuilddeps.pyassets:
                 # writepy only scans directories if it is a Python package
                 # (ex. with __init__.py). Therefore scan the top-level
@@ -1250,9 +1852,13 @@ class buildpyzip(Command):
                             # process those.
                             process_top_level(path)
                         elif path.endswith(".py") or os.path.isdir(path):
-                            f.writepy(path)
+                            collector.writepy(path)
 
                 process_top_level(extracteddir)
+            collector.close()
+
+            for arcname in sorted(entries):
+                f.write(entries[arcname], arcname)
 
 
 class buildhgextindex(Command):
@@ -1266,7 +1872,29 @@ class buildhgextindex(Command):
     def finalize_options(self):
         pass
 
+    def _signature(self):
+        """Hash of the paths and mtimes of the .py files under hgext"""
+        h = hashlib.blake2b(digest_size=16)
+        indexpath = os.path.normpath(self._indexfilename)
+        for root, dirs, files in os.walk(os.path.dirname(indexpath)):
+            dirs.sort()
+            for name in sorted(files):
+                path = pjoin(root, name)
+                if not name.endswith(".py") or path == indexpath:
+                    continue
+                mtime = os.stat(path).st_mtime_ns
+                h.update(b"%s\0%d\0" % (path.encode("utf-8"), mtime))
+        return h.hexdigest()
+
     def run(self):
+        sigline = "# sig: %s\n" % self._signature()
+        try:
+            with open(self._indexfilename, "r") as f:
+                if f.readline() == sigline:
+                    return
+        except IOError:
+            pass
+
         if os.path.exists(self._indexfilename):
             with open(self._indexfilename, "w") as f:
                 f.write("# empty\n")
@@ -1281,9 +1909,10 @@ class buildhgextindex(Command):
             raise DistutilsExecError(err)
 
         with open(self._indexfilename, "w") as f:
+            f.write(sigline)
             f.write("# this file is autogenerated by setup.py\n")
             f.write("docs = ")
-            f.write(out)
+            f.write(out.decode("utf-8"))
 
 
 class hginstall(install):
@@ -1323,20 +1952,44 @@ class hginstalllib(install_lib):
     def run(self):
         realcopyfile = file_util.copy_file
 
-        def copyfileandsetmode(*args, **kwargs):
-            src, dst = args[0], args[1]
-            dst, copied = realcopyfile(*args, **kwargs)
-            if copied:
-                st = os.stat(src)
-                # Persist executable bit (apply it to group and other if user
-                # has it)
-                if st[stat.ST_MODE] & stat.S_IXUSR:
-                    setmode = int("0755", 8)
-                else:
-                    setmode = int("0644", 8)
-                m = stat.S_IMODE(st[stat.ST_MODE])
-                m = (m & ~int("0777", 8)) | setmode
-                os.chmod(dst, m)
+        def copyfileandsetmode(
+            src, dst, preserve_mode=1, preserve_times=1, update=0, link=None, **kwargs
+        ):
+            if link or os.path.isdir(dst):
+                dst, copied = realcopyfile(
+                    src, dst, preserve_mode, preserve_times, update, link, **kwargs
+                )
+                if copied:
+                    os.chmod(dst, installmode(os.stat(src)))
+                return dst, copied
+            if update and not newer(src, dst):
+                return dst, 0
+            if kwargs.get("verbose", 1) >= 1:
+                log.info("copying %s -> %s", src, dst)
+            if kwargs.get("dry_run"):
+                return dst, 1
+            # shutil.copyfile uses sendfile/fcopyfile/CopyFileW instead of the
+            # 16KB read loop in distutils, and one stat covers times and mode.
+            st = os.stat(src)
+            # Replace dst with a new inode like distutils does. Rewriting it in
+            # place can crash processes that have the old .so mapped, and fails
+            # on read-only files.
+            tryunlink(dst)
+            shutil.copyfile(src, dst)
+            if preserve_times:
+                os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+            os.chmod(dst, installmode(st))
+            return dst, 1
+
+        def installmode(st):
+            # Persist executable bit (apply it to group and other if user
+            # has it)
+            if st[stat.ST_MODE] & stat.S_IXUSR:
+                setmode = int("0755", 8)
+            else:
+                setmode = int("0644", 8)
+            m = stat.S_IMODE(st[stat.ST_MODE])
+            return (m & ~int("0777", 8)) | setmode
 
         file_util.copy_file = copyfileandsetmode
         try:
@@ -1345,6 +1998,72 @@ class hginstalllib(install_lib):
         finally:
             file_util.copy_file = realcopyfile
 
+    def install(self):
+        if not os.path.isdir(self.build_dir):
+            self.warn(
+                "'%s' does not exist -- no Python modules to install" % self.build_dir
+            )
+            return
+
+        # Copy each top-level package on its own thread. The copies spend
+        # their time in system calls that release the GIL.
+        def installentry(name):
+            src = pjoin(self.build_dir, name)
+            dst = pjoin(self.install_dir, name)
+            if os.path.isdir(src):
+                return self.copy_tree(src, dst)
+            return [self.copy_file(src, dst)[0]]
+
+        self.mkpath(self.install_dir)
+        names = sorted(os.listdir(self.build_dir))
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(8, len(names)))) as e:
+            return [path for paths in e.map(installentry, names) for path in paths]
+
+    def byte_compile(self, files):
+        """Byte-compile the installed files using all CPUs
+
+        distutils compiles one file at a time. Spread the same files over a
+        process pool instead.
+        """
+        if sys.dont_write_bytecode:
+            self.warn("byte-compiling is disabled, skipping.")
+            return
+        if self.dry_run:
+            return
+
+        import compileall
+
+        levels = []
+        if self.compile:
+            levels.append(0)
+        if self.optimize > 0:
+            levels.append(self.optimize)
+        installroot = self.get_finalized_command("install").root
+        paths, ddirs, optimizes = [], [], []
+        for path in files:
+            if not path.endswith(".py"):
+                continue
+            ddir = None
+            if installroot and path.startswith(installroot):
+                # Record the final install path in the .pyc, like distutils
+                ddir = os.path.dirname(path[len(installroot) :])
+            for level in levels:
+                paths.append(path)
+                ddirs.append(ddir)
+                optimizes.append(level)
+        if not paths:
+            return
+
+        n = len(paths)
+        # compile_file(fullname, ddir, force, rx, quiet, legacy, optimize)
+        args = (paths, ddirs, [self.force] * n, [None] * n, [1] * n, [False] * n)
+        args += (optimizes,)
+        if canforkworkers and n > 1:
+            with concurrent.futures.ProcessPoolExecutor() as pool:
+                list(pool.map(compileall.compile_file, *args, chunksize=64))
+        else:
+            list(map(compileall.compile_file, *args))
+
     def _installpyzip(self):
         for src, dst in [("edenscmdeps.zip", "edenscmdeps.zip")]:
             srcpath = pjoin(builddir, src)
@@ -1405,22 +2124,29 @@ class hginstallscripts(install_scripts):
             libdir = uplevel * (".." + os.sep) + self.install_lib[len(common) :]
 
         for outfile in self.outfiles:
+            # Scan a mapping of the file so scripts without @LIBDIR@ (and
+            # binaries) are never copied into memory.
             with open(outfile, "rb") as fp:
-                data = fp.read()
-
-            # skip binary files
-            if b"\0" in data:
-                continue
-
-            # During local installs, the shebang will be rewritten to the final
-            # install path. During wheel packaging, the shebang has a special
-            # value.
-            if data.startswith(b"#!python"):
-                log.info(
-                    "not rewriting @LIBDIR@ in %s because install path "
-                    "not known" % outfile
-                )
-                continue
+                if os.fstat(fp.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    # skip binary files
+                    if mm.find(b"\0") != -1:
+                        continue
+
+                    # During local installs, the shebang will be rewritten to
+                    # the final install path. During wheel packaging, the
+                    # shebang has a special value.
+                    if mm[:8] == b"#!python":
+                        log.info(
+                            "not rewriting @LIBDIR@ in %s because install path "
+                            "not known" % outfile
+                        )
+                        continue
+
+                    if mm.find(b"@LIBDIR@") == -1:
+                        continue
+                    data = mm[:]
 
             data = data.replace(b"@LIBDIR@", libdir.encode(libdir_escape))
             with open(outfile, "wb") as fp:
@@ -1485,6 +2211,10 @@ if havefb:
     packages.append("edenscm.mercurial.fb")
     packages.append("edenscm.mercurial.fb.mergedriver")
 
+# (package, relative directory) pairs, computed once for the commands that
+# walk the package directories.
+packagepaths = tuple((p, p.replace(".", os.sep)) for p in packages)
+
 common_depends = [
     "edenscm/mercurial/bitmanipulation.h",
     "edenscm/mercurial/compat.h",
@@ -1506,6 +2236,11 @@ def filter_existing_dirs(dirs):
     return [d for d in dirs if os.path.isdir(d)]
 
 
+# Same as distutils build. sys.version[:3] would give "3.1" on Python 3.10.
+pyversion = "%d.%d" % sys.version_info[:2]
+
+
+@functools.lru_cache(maxsize=None)
 def distutils_dir_name(dname):
     """Returns the name of a distutils build directory"""
     if dname == "scripts":
@@ -1515,7 +2250,7 @@ def distutils_dir_name(dname):
     else:
         f = "{dirname}.{platform}-{version}"
     return f.format(
-        dirname=dname, platform=distutils.util.get_platform(), version=sys.version[:3]
+        dirname=dname, platform=distutils.util.get_platform(), version=pyversion
     )
 
 
@@ -1554,11 +2289,11 @@ osutil_cflags = []
 
 # platform specific macros
 for plat, func in [("bsd", "setproctitle")]:
-    if re.search(plat, sys.platform) and hasfunction(new_compiler(), func):
+    if re.search(plat, sys.platform) and hasfunction(probecompiler(), func):
         osutil_cflags.append("-DHAVE_%s" % func.upper())
 
 if "linux" in sys.platform and cancompile(
-    new_compiler(),
+    probecompiler(),
     """
      #include <fcntl.h>
      #include <sys/fanotify.h>
@@ -1651,7 +2386,13 @@ def cythonize(*args, **kwargs):
 
 # Cython modules
 # see http://cython.readthedocs.io/en/latest/src/reference/compilation.html
-cythonopts = {"unraisable_tracebacks": False, "c_string_type": "bytes"}
+# boundscheck and wraparound stay enabled: clindex.pyx relies on negative
+# indexing, and unchecked indexing of Python sequences can crash.
+cythonopts = {
+    "unraisable_tracebacks": False,
+    "c_string_type": "bytes",
+    "language_level": 2,
+}
 
 extmodules += cythonize(
     [
@@ -1681,6 +2422,7 @@ extmodules += cythonize(
         ),
     ],
     compiler_directives=cythonopts,
+    nthreads=(os.cpu_count() or 1) if canforkworkers else 0,
 )
 
 libraries = [
@@ -1726,11 +2468,21 @@ if not iswindows:
         )
     )
 
-# let's add EXTRA_LIBS to every buildable
+# Extra C compiler flags, appended after the defaults so they win, e.g. for a
+# build that only runs on this machine:
+#
+#   HG_EXTRA_CFLAGS="-O3 -march=native -funroll-loops" python setup.py build
+extracflags = shlex.split(os.environ.get("HG_EXTRA_CFLAGS", ""))
+
+# let's add EXTRA_LIBS and HG_EXTRA_CFLAGS to every buildable
 for extmodule in extmodules:
     extmodule.libraries.extend(extra_libs)
+    if extracflags:
+        extmodule.extra_compile_args = list(extmodule.extra_compile_args) + extracflags
 for libname, libspec in libraries:
     libspec["libraries"] = libspec.get("libraries", []) + extra_libs
+    if extracflags:
+        libspec["extra_args"] = list(libspec.get("extra_args") or []) + extracflags
 
 try:
     from distutils import cygwinccompiler
@@ -1746,6 +2498,7 @@ try:
                     getattr(self, i).remove("-mno-cygwin")
                 except ValueError:
                     pass
+            usecompilercache(self)
 
     cygwinccompiler.Mingw32CCompiler = HackedMingw32CCompiler
 except ImportError:
@@ -1772,6 +2525,12 @@ if os.name == "nt":
             self.ldflags_shared.append("/DEBUG")
             self.ldflags_shared_debug.append("/ignore:4197")
             self.compile_options.append("/Z7")
+            # clcache is a drop-in replacement for cl.exe. /Z7 above keeps
+            # debug info in the objects, which clcache needs to cache them.
+            if not os.environ.get("HG_DISABLE_CCACHE"):
+                clcache = find_executable("clcache")
+                if clcache:
+                    self.cc = clcache
 
     msvccompiler.MSVCCompiler = HackedMSVCCompiler
 
@@ -1790,13 +2549,45 @@ def ordinarypath(p):
     return p and p[0] != "." and p[-1] != "~"
 
 
-for root in ("mercurial/templates",):
-    for curdir, dirs, files in os.walk(os.path.join("edenscm", root)):
-        curdir = curdir.split(os.sep, 1)[1]
-        dirs[:] = filter(ordinarypath, dirs)
-        for f in filter(ordinarypath, files):
-            f = os.path.join(curdir, f)
-            packagedata["edenscm"].append(f)
+packagedatacachepath = pjoin(builddir, "packagedata.json")
+
+
+def packagedatafiles(roots):
+    """List the ordinary files under edenscm/<root>, relative to edenscm/
+
+    The result is cached in build/ along with the mtime of every directory
+    walked. Adding, removing or renaming an entry changes its directory's
+    mtime, so an unchanged tree costs one stat per directory.
+    """
+    try:
+        with open(packagedatacachepath, "r") as f:
+            cached = json.load(f)
+        if cached["roots"] == list(roots) and all(
+            os.stat(d).st_mtime_ns == mtime for d, mtime in cached["dirs"].items()
+        ):
+            return cached["files"]
+    except Exception:
+        pass
+
+    dirmtimes = {}
+    result = []
+    for root in roots:
+        for curdir, dirs, files in os.walk(os.path.join("edenscm", root)):
+            dirmtimes[curdir] = os.stat(curdir).st_mtime_ns
+            curdir = curdir.split(os.sep, 1)[1]
+            dirs[:] = filter(ordinarypath, dirs)
+            for f in filter(ordinarypath, files):
+                result.append(os.path.join(curdir, f))
+
+    if os.path.isdir(builddir):
+        cached = {"roots": list(roots), "dirs": dirmtimes, "files": result}
+        write_if_changed(
+            packagedatacachepath, json.dumps(cached, sort_keys=True).encode("utf-8")
+        )
+    return result
+
+
+packagedata["edenscm"] += packagedatafiles(("mercurial/templates",))
 
 
 # distutils expects version to be str/unicode. Converting it to
@@ -1850,7 +2641,46 @@ from distutils.dep_util import newer_group
 from distutils.errors import DistutilsSetupError
 
 
+# Two-stage PGO build of the C libraries:
+#
+#   python setup.py --pgo=generate build
+#   <run a representative workload, e.g. log/diff/update on a scratch repo>
+#   python setup.py --pgo=use build --force
+#
+# Setting HG_PGO_PHASE=generate or HG_PGO_PHASE=use does the same as --pgo.
+# gcc reads the .gcda files from pgodir directly. clang needs them merged
+# into pgodir/default.profdata with llvm-profdata first.
+pgodir = pjoin(builddir, "pgo")
+
+
+def optimizationargs(dist, cc):
+    """Extra compiler arguments for the --pgo and --lto options"""
+    args = []
+    if not (dist.pgo or dist.lto):
+        return args
+    if cc.compiler_type == "msvc":
+        log.warn("--pgo and --lto are not supported with MSVC, ignoring")
+        return args
+    if dist.pgo == "generate":
+        args.append("-fprofile-generate=%s" % pgodir)
+    elif dist.pgo == "use":
+        args.append("-fprofile-use=%s" % pgodir)
+    if dist.lto:
+        # Fat objects carry regular code next to the LTO IR, so the archives
+        # still link where the final link is not LTO-aware (e.g. via rustc).
+        lto = ["-flto", "-ffat-lto-objects"]
+        if cancompile(cc, "int main(void) { return 0; }\n", lto):
+            args += lto
+        else:
+            log.warn("compiler does not support %s, ignoring --lto" % " ".join(lto))
+    return args
+
+
 def build_libraries(self, libraries):
+    # build_clib creates its own compiler. It usually picks the cache up
+    # from $CC already, but not when the compiler ignores $CC.
+    usecompilercache(self.compiler)
+    optargs = optimizationargs(self.distribution, self.compiler)
     for (lib_name, build_info) in libraries:
         sources = build_info.get("sources")
         if sources is None or not isinstance(sources, (list, tuple)):
@@ -1874,7 +2704,7 @@ def build_libraries(self, libraries):
         # files in a temporary build directory.)
         macros = build_info.get("macros", [])
         include_dirs = build_info.get("include_dirs")
-        extra_args = build_info.get("extra_args")
+        extra_args = list(build_info.get("extra_args") or []) + optargs
         objects = self.compiler.compile(
             sources,
             output_dir=self.build_temp,
@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+
+import ast
+import os
+import shutil
+import tempfile
+import unittest
+
+
+# setup.py runs setup() when imported, so only pull out the function under test
+setuppath = os.path.join(
+    os.environ.get("TESTDIR", os.path.dirname(os.path.abspath(__file__))),
+    "..",
+    "setup.py",
+)
+
+
+def loadsetupfunction(name):
+    with open(setuppath) as f:
+        tree = ast.parse(f.read(), setuppath)
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            module = ast.Module(body=[node], type_ignores=[])
+            namespace = {"os": os, "pjoin": os.path.join}
+            exec(compile(module, setuppath, "exec"), namespace)
+            return namespace[name]
+    raise AssertionError("%s not found in setup.py" % name)
+
+
+stalepycs = loadsetupfunction("stalepycs")
+
+
+class teststalepycs(unittest.TestCase):
+    def setUp(self):
+        self._root = tempfile.mkdtemp("stalepycstest")
+
+    def tearDown(self):
+        shutil.rmtree(self._root, True)
+
+    def _touch(self, *parts):
+        path = os.path.join(self._root, *parts)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb"):
+            pass
+        return path
+
+    def testlegacylayout(self):
+        self._touch("pkg", "kept.py")
+        self._touch("pkg", "kept.pyc")
+        stale = self._touch("pkg", "gone.pyc")
+        self.assertEqual(list(stalepycs(self._root, ["pkg"])), [stale])
+
+    def testpycachelayout(self):
+        self._touch("pkg", "mod.py")
+        self._touch("pkg", "__pycache__", "mod.cpython-311.pyc")
+        self._touch("pkg", "__pycache__", "gone.cpython-311.pyc")
+        self.assertEqual(list(stalepycs(self._root, ["pkg"])), [])
+
+    def testnestedpackages(self):
+        self._touch("pkg", "sub", "mod.py")
+        stale = self._touch("pkg", "sub", "old.pyc")
+        # only the listed package directories are scanned
+        self._touch("notapackage", "other.pyc")
+        self.assertEqual(
+            list(stalepycs(self._root, ["pkg", os.path.join("pkg", "sub"), "missing"])),
+            [stale],
+        )
+
+
+if __name__ == "__main__":
+    import silenttestrunner
+
+    silenttestrunner.main(__name__)
@@ -226,8 +226,8 @@ class _LocalService(baseservice.BaseService):
         filename = os.path.join(
             self.path, self._workspacefilename("checkoutlocations", workspace)
         )
-        with open(filename, "w+") as f:
-            json.dump(data, f)
+        with open(filename, "wb") as f:
+            f.write(pycompat.encodeutf8(json.dumps(data)))
 
     def getworkspaces(self, reponame, prefix):
         if prefix is None:
@@ -7,16 +7,64 @@ from __future__ import absolute_import
 
 import hashlib
 import json
+import re
+import sys
 import time
 
+from edenscm.mercurial import util
 from edenscm.mercurial.i18n import _
 from edenscm.mercurial.pycompat import encodeutf8, ensurestr
 
 from . import error as ccerror
 
 
+try:
+    # orjson parses from and serializes to bytes in C, which is several
+    # times faster than the json module for large workspaces.
+    import orjson
+
+    _jsonloads = orjson.loads
+    _jsondumps = orjson.dumps
+except ImportError:
+    _jsonloads = json.loads
+
+    def _jsondumps(data):
+        return encodeutf8(json.dumps(data))
+
+
+if sys.version_info[0] >= 3:
+    # JSON strings already load as str, so the loaded containers can be used
+    # as they are instead of being rebuilt item by item
+    _strlist = list
+
+    def _strdict(d):
+        return d
+
+
+else:
+
+    def _strlist(items):
+        return [ensurestr(s) for s in items]
+
+    def _strdict(d):
+        return {ensurestr(n): ensurestr(v) for n, v in d.items()}
+
+
 NOTSET = object()
 
+# everything str.isalnum() rejects
+_nonalnumre = re.compile(r"[\W_]+", re.UNICODE)
+
+
+@util.lrucachefunc
+def _filename(prefix, workspacename):
+    # make a unique valid filename
+    return (
+        prefix
+        + _nonalnumre.sub("", workspacename)
+        + ".%s" % (hashlib.sha256(encodeutf8(workspacename)).hexdigest()[0:5])
+    )
+
 
 class SyncState(object):
     """
@@ -28,12 +76,7 @@ class SyncState(object):
 
     @classmethod
     def _filename(cls, workspacename):
-        # make a unique valid filename
-        return (
-            cls.prefix
-            + "".join(x for x in workspacename if x.isalnum())
-            + ".%s" % (hashlib.sha256(encodeutf8(workspacename)).hexdigest()[0:5])
-        )
+        return _filename(cls.prefix, workspacename)
 
     @classmethod
     def erasestate(cls, repo, workspacename):
@@ -53,31 +96,24 @@ class SyncState(object):
         self.repo = repo
         self.prevstate = None
         if repo.svfs.exists(self.filename):
-            with repo.svfs.open(self.filename, "r") as f:
+            with repo.svfs.open(self.filename, "rb") as f:
                 try:
-                    data = json.load(f)
+                    data = _jsonloads(f.read())
                 except Exception:
                     raise ccerror.InvalidWorkspaceDataError(
                         repo.ui, _("failed to parse %s") % self.filename
                     )
 
                 self.version = data["version"]
-                self.heads = [ensurestr(h) for h in data["heads"]]
-                self.bookmarks = {
-                    ensurestr(n): ensurestr(v) for n, v in data["bookmarks"].items()
-                }
-                self.remotebookmarks = {
-                    ensurestr(n): ensurestr(v)
-                    for n, v in data.get("remotebookmarks", {}).items()
-                }
+                self.heads = _strlist(data["heads"])
+                self.bookmarks = _strdict(data["bookmarks"])
+                self.remotebookmarks = _strdict(data.get("remotebookmarks", {}))
                 self.maxage = data.get("maxage", None)
-                self.omittedheads = [ensurestr(h) for h in data.get("omittedheads", ())]
-                self.omittedbookmarks = [
-                    ensurestr(n) for n in data.get("omittedbookmarks", ())
-                ]
-                self.omittedremotebookmarks = [
-                    ensurestr(n) for n in data.get("omittedremotebookmarks", ())
-                ]
+                self.omittedheads = _strlist(data.get("omittedheads", ()))
+                self.omittedbookmarks = _strlist(data.get("omittedbookmarks", ()))
+                self.omittedremotebookmarks = _strlist(
+                    data.get("omittedremotebookmarks", ())
+                )
                 self.lastupdatetime = data.get("lastupdatetime", None)
         else:
             self.version = 0
@@ -129,7 +165,7 @@ class SyncState(object):
         tr.addfilegenerator(
             self.filename,
             [self.filename],
-            lambda f: f.write(encodeutf8(json.dumps(data))),
+            lambda f: f.write(_jsondumps(data)),
         )
         self.prevstate = (self.version, self.heads, self.bookmarks)
         self.version = version
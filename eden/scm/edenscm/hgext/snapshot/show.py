@@ -3,6 +3,9 @@
 # This software may be used and distributed according to the terms of the
 # GNU General Public License version 2.
 
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 from edenscm.mercurial import error, scmutil
 from edenscm.mercurial.cmdutil import changeset_printer, jsonchangeset
 from edenscm.mercurial.context import memctx, memfilectx
@@ -11,7 +14,15 @@ from edenscm.mercurial.edenapi_upload import (
 )
 from edenscm.mercurial.i18n import _
 from edenscm.mercurial.node import nullid
-from edenscm.mercurial.util import pickle
+
+
+def _hashable(value):
+    """Turn the dicts and lists edenapi deserializes into a hashable key"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
 
 
 def _snapshot2ctx(repo, snapshot):
@@ -30,34 +41,55 @@ def _snapshot2ctx(repo, snapshot):
         repo.pull(headnodes=(parent,))
 
     parents = (parent, nullid)
+    # one pass over file_changes; the dict keys double as the memctx file list
     path2filechange = {f[0]: f[1] for f in snapshot["file_changes"]}
+    files = tuple(path2filechange)
 
     def token2cacheable(token):
         data = token["data"]
-        return pickle.dumps((data["id"], data["bubble_id"]))
+        return (_hashable(data["id"]), data["bubble_id"])
+
+    def filechange(change):
+        if change == "Deletion" or change == "UntrackedDeletion":
+            return None
+        elif "Change" in change or "UntrackedChange" in change:
+            return change.get("Change") or change["UntrackedChange"]
+        else:
+            raise error.Abort(_("Unknown file change {}").format(change))
 
+    # Download all files in parallel up front. Fetching them lazily from
+    # getfile would pay one round trip after another.
+    tokens = {}
+    for change in path2filechange.values():
+        change = filechange(change)
+        if change is not None:
+            token = change["upload_token"]
+            tokens[token2cacheable(token)] = token
     cache = {}
+    if tokens:
+        reponame = getreponame(repo)
+        download = repo.edenapi.downloadfiletomemory
+        with ThreadPoolExecutor(max_workers=min(16, len(tokens))) as executor:
+            futures = [
+                (key, executor.submit(download, reponame, token))
+                for key, token in tokens.items()
+            ]
+            for key, future in futures:
+                cache[key] = future.result()
 
     def getfile(repo, memctx, path):
         change = path2filechange.get(path)
         if change is None:
             return repo[parent][path]
-        if change == "Deletion" or change == "UntrackedDeletion":
+        change = filechange(change)
+        if change is None:
             return None
-        elif "Change" in change or "UntrackedChange" in change:
-            change = change.get("Change") or change["UntrackedChange"]
-            token = change["upload_token"]
-            key = token2cacheable(token)
-            if key not in cache:
-                # Possible future optimisation: Download files in parallel
-                cache[key] = repo.edenapi.downloadfiletomemory(getreponame(repo), token)
-            islink = change["file_type"] == "Symlink"
-            isexec = change["file_type"] == "Executable"
-            return memfilectx(
-                repo, None, path, data=cache[key], islink=islink, isexec=isexec
-            )
-        else:
-            raise error.Abort(_("Unknown file change {}").format(change))
+        key = token2cacheable(change["upload_token"])
+        islink = change["file_type"] == "Symlink"
+        isexec = change["file_type"] == "Executable"
+        return memfilectx(
+            repo, None, path, data=cache[key], islink=islink, isexec=isexec
+        )
 
     time, tz = snapshot["time"], snapshot["tz"]
     if time or tz:
@@ -69,7 +101,7 @@ def _snapshot2ctx(repo, snapshot):
         repo,
         parents,
         text="",
-        files=list(path2filechange.keys()),
+        files=files,
         filectxfn=getfile,
         user=snapshot["author"] or None,
         date=date,
@@ -77,9 +109,22 @@ def _snapshot2ctx(repo, snapshot):
     return ctx
 
 
-def show(ui, repo, csid, **opts):
+# the matcher is the same for every snapshot shown from a repo, as long as
+# the working directory does not move (chg servers can chdir between commands)
+_matchallcache = weakref.WeakKeyDictionary()
+
+
+def _matchall(repo):
+    cwd = repo.getcwd()
+    cached = _matchallcache.get(repo)
+    if cached is None or cached[0] != cwd:
+        cached = _matchallcache[repo] = (cwd, scmutil.matchall(repo))
+    return cached[1]
+
+
+def _fetchsnapshot(repo, csid):
     try:
-        snapshot = repo.edenapi.fetchsnapshot(
+        return repo.edenapi.fetchsnapshot(
             getreponame(repo),
             {
                 "cs_id": bytes.fromhex(csid),
@@ -87,15 +132,24 @@ def show(ui, repo, csid, **opts):
         )
     except Exception:
         raise error.Abort(_("snapshot doesn't exist"))
+
+
+def show(ui, repo, csid, **opts):
+    showmany(ui, repo, [csid], **opts)
+
+
+def showmany(ui, repo, csids, **opts):
+    """show several snapshots through a single displayer"""
+    match = _matchall(repo)
+    printeropt = {"patch": not opts["stat"], "stat": opts["stat"]}
+    buffered = False
+    if opts["json"] is True:
+        displayer = jsonchangeset(ui, repo, match, printeropt, buffered)
     else:
-        ctx = _snapshot2ctx(repo, snapshot)
-        match = scmutil.matchall(repo)
-        printeropt = {"patch": not opts["stat"], "stat": opts["stat"]}
-        buffered = False
-        if opts["json"] is True:
-            displayer = jsonchangeset(ui, repo, match, printeropt, buffered)
-        else:
+        displayer = changeset_printer(ui, repo, match, printeropt, buffered)
+    for csid in csids:
+        ctx = _snapshot2ctx(repo, _fetchsnapshot(repo, csid))
+        if opts["json"] is not True:
             ui.status(_("snapshot: {}\n").format(csid))
-            displayer = changeset_printer(ui, repo, match, printeropt, buffered)
         displayer.show(ctx)
-        displayer.close()
+    displayer.close()
@@ -183,26 +183,26 @@ def parsebundlespec(repo, spec, strict=True, externalnames=False):
 def readbundle(ui, fh, fname, vfs=None):
     rawheader = changegroup.readexactly(fh, 4)
     header = pycompat.decodeutf8(rawheader, errors="replace")
+    # split the header once; everything below compares these slices
+    magic, version = header[0:2], header[2:4]
 
     alg = None
     if not fname:
         fname = "stream"
-        if not header.startswith("HG") and rawheader.startswith(b"\0"):
+        if magic != "HG" and rawheader[0:1] == b"\0":
             fh = changegroup.headerlessfixup(fh, rawheader)
-            header = "HG10"
+            magic, version = "HG", "10"
             alg = "UN"
     elif vfs:
         fname = vfs.join(fname)
 
-    magic, version = header[0:2], header[2:4]
-
     if magic != "HG":
         raise error.Abort(_("%s: not a Mercurial bundle") % fname)
     if version == "10":
         if alg is None:
             alg = pycompat.decodeutf8(changegroup.readexactly(fh, 2))
         return changegroup.cg1unpacker(fh, alg)
-    elif version.startswith("2"):
+    elif version[0:1] == "2":
         return bundle2.getunbundler(ui, fh, magicstring=magic + version)
     elif version == "S1":
         return streamclone.streamcloneapplier(fh)
@@ -57,7 +57,9 @@ def dump(data, fp):
     if sys.version_info[0] < 3:
         return fp.write(dumps(data))
     else:
-        return _sysjson.dump(data, fp)
+        # _sysjson.dump() writes every token separately; serialize first so
+        # the file sees one write
+        return fp.write(_sysjson.dumps(data))
 
 
 def _rapply(f, xs):
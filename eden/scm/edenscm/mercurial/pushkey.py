@@ -52,7 +52,8 @@ def list(repo, namespace):
 
 def encodekeys(keys):
     """encode the content of a pushkey namespace for exchange over the wire"""
-    return b"\n".join([b"%s\t%s" % (encodeutf8(k), encodeutf8(v)) for k, v in keys])
+    # encode the whole response at once instead of two strings per key
+    return encodeutf8("\n".join(["%s\t%s" % (k, v) for k, v in keys]))
 
 
 def decodekeys(data):
@@ -61,7 +62,15 @@ def decodekeys(data):
     # retrieve commits in the same order of creation to mantain the order of
     # revision codes. See T24417531
     result = util.sortdict()
-    for l in data.splitlines():
-        k, v = l.split(b"\t")
-        result[decodeutf8(k)] = decodeutf8(v)
+    if b"\r" in data:
+        lines = [decodeutf8(l) for l in data.splitlines()]
+    else:
+        # decode the whole response at once instead of two strings per key.
+        # str.splitlines() breaks on more characters than bytes.splitlines().
+        lines = decodeutf8(data).split("\n")
+        if lines[-1] == "":
+            lines.pop()
+    for l in lines:
+        k, v = l.split("\t")
+        result[k] = v
     return result
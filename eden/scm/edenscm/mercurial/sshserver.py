@@ -64,9 +64,27 @@ class sshserver(wireproto.abstractserverproto):
 
     def getfile(self, fpout):
         self.sendresponse("")
+        if not util.safehasattr(self.fin, "readinto"):
+            count = int(self.fin.readline())
+            while count:
+                fpout.write(self.fin.read(count))
+                count = int(self.fin.readline())
+            return
+
+        # read every frame into one reused buffer rather than allocating a
+        # bytes object per frame
+        buf = memoryview(bytearray(65536))
         count = int(self.fin.readline())
         while count:
-            fpout.write(self.fin.read(count))
+            if count > len(buf):
+                buf = memoryview(bytearray(count))
+            pos = 0
+            while pos < count:
+                n = self.fin.readinto(buf[pos:count])
+                if not n:
+                    break
+                pos += n
+            fpout.write(buf[:pos])
             count = int(self.fin.readline())
 
     def redirect(self):
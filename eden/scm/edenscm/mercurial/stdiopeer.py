@@ -97,6 +97,10 @@ class stdiopeer(wireproto.wirepeer):
             work += chunk
         yield wireproto.unescapebytearg(work)
 
+    def _maxargsize(self):
+        # arguments are sent length-prefixed over the pipe
+        return None
+
     def _callstream(self, cmd, **args):
         args = args
         self.ui.debug("sending %s command\n" % cmd)
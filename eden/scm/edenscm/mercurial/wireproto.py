@@ -12,9 +12,12 @@
 
 from __future__ import absolute_import
 
+import binascii
 import functools
 import hashlib
 import os
+import re
+import sys
 import tempfile
 import time
 
@@ -37,7 +40,7 @@ from . import (
     util,
 )
 from .i18n import _
-from .node import bbin, bhex, bin, hex, nullid
+from .node import bbin, bhex, hex, nullid
 from .pycompat import decodeutf8, encodeutf8, iteritems, range
 
 
@@ -165,17 +168,57 @@ future = peer.future
 # list of nodes encoding / decoding
 
 
+# bytes.hex() can insert separators itself since Python 3.8
+_hexwithsep = sys.version_info >= (3, 8)
+
+
 def decodelist(l, sep=" "):
     if l:
-        return [bin(v) for v in l.split(sep)]
+        # map() straight to unhexlify avoids a Python-level bin() call per node
+        try:
+            return list(map(bbin, l.split(sep)))
+        except binascii.Error as e:
+            raise TypeError(e)
     return []
 
 
 def encodelist(l, sep=" "):
-    try:
-        return sep.join(map(hex, l))
-    except TypeError:
-        raise
+    l = list(l)
+    if _hexwithsep and len(sep) == 1 and set(map(len, l)) == {20}:
+        # hex all nodes in one C call, which also inserts the separators
+        return b"".join(l).hex(sep, 20)
+    return sep.join(map(hex, l))
+
+
+def _encodepairs(pairs):
+    """encode (top, bottom) node pairs as the between command expects"""
+    nodes = [n for p in pairs for n in p]
+    if len(nodes) != 2 * len(pairs) or set(map(len, nodes)) != {20}:
+        return " ".join([encodelist(p, "-") for p in pairs])
+    # hex the whole request at once and slice the pairs out of it
+    h = b"".join(nodes).hex()
+    return " ".join(
+        ["%s-%s" % (h[i : i + 40], h[i + 40 : i + 80]) for i in range(0, len(h), 80)]
+    )
+
+
+# branch name encoding / decoding
+
+# characters that urlreq.quote() escapes with its default safe="/"
+_branchunsafere = re.compile(r"[^A-Za-z0-9_.\-~/]")
+
+
+def quotebranch(name):
+    # most branch names need no escaping, skip quote()'s per-call setup
+    if _branchunsafere.search(name) is None:
+        return name
+    return urlreq.quote(name)
+
+
+def unquotebranch(name):
+    if "%" not in name:
+        return name
+    return urlreq.unquote(name)
 
 
 # batched call argument encoding
@@ -321,7 +364,7 @@ class wirepeer(repository.legacypeer):
             for branchpart in d.splitlines():
                 branchpart = pycompat.decodeutf8(branchpart)
                 branchname, branchheads = branchpart.split(" ", 1)
-                branchname = urlreq.unquote(branchname)
+                branchname = unquotebranch(branchname)
                 branchheads = decodelist(branchheads)
                 branchmap[branchname] = branchheads
             yield branchmap
@@ -515,15 +558,34 @@ class wirepeer(repository.legacypeer):
             self._abort(error.ResponseError(_("unexpected response:"), d))
 
     def between(self, pairs):
-        batch = 8  # avoid giant requests
-        r = []
+        batch = 256  # pairs per request, avoid giant requests
+        pipelined = 4  # requests per round trip when batching
+        maxargsize = self._maxargsize()
+        if maxargsize is not None:
+            # two hex nodes and a separator per pair
+            pairsize = 2 * 40 + 2
+            batch = max(1, min(batch, maxargsize // pairsize))
+            pipelined = max(1, min(pipelined, maxargsize // (batch * pairsize)))
+        reqs = []
         for i in range(0, len(pairs), batch):
-            n = " ".join([encodelist(p, "-") for p in pairs[i : i + batch]])
-            d = self._call("between", pairs=n)
-            try:
-                r.extend(l and decodelist(l) or [] for l in d.splitlines())
-            except ValueError:
-                self._abort(error.ResponseError(_("unexpected response:"), d))
+            n = _encodepairs(pairs[i : i + batch])
+            reqs.append(("between", {"pairs": n}))
+        if pipelined > 1 and len(reqs) > 1 and self.capable("batch"):
+            groups = [reqs[i : i + pipelined] for i in range(0, len(reqs), pipelined)]
+        else:
+            groups = [[req] for req in reqs]
+        r = []
+        for group in groups:
+            if len(group) > 1:
+                responses = self._submitbatch(group)
+            else:
+                responses = [self._submitone(op, args) for op, args in group]
+            for d in responses:
+                try:
+                    d = decodeutf8(d)
+                    r.extend(l and decodelist(l) or [] for l in d.splitlines())
+                except ValueError:
+                    self._abort(error.ResponseError(_("unexpected response:"), d))
         return r
 
     def changegroup(self, nodes, kind):
@@ -563,6 +625,19 @@ class wirepeer(repository.legacypeer):
     def _submitone(self, op, args):
         return self._call(op, **args)
 
+    def _maxargsize(self):
+        """maximum size in bytes of the arguments of one request, or None
+
+        Without the ``httpheader`` capability, HTTP peers send arguments in
+        the URL query string. Otherwise they are split into headers of the
+        advertised size. Servers and proxies limit both.
+        """
+        headersize = self.capable("httpheader")
+        if headersize:
+            # a few headers of the advertised size are accepted everywhere
+            return 8 * int(headersize)
+        return 1024
+
     def debugwireargs(self, one, two, three=None, four=None, five=None):
         # don't pass optional arguments left at their default value
         opts = {}
@@ -913,33 +988,40 @@ def batch(repo, proto, cmds, others):
     return b";".join(res)
 
 
+def _encodelines(nodelists):
+    """encode each list of nodes as one newline-terminated line
+
+    The trailing newline is added once to the joined result rather than to
+    every line, so no per-line intermediate strings are built.
+    """
+    lines = [encodelist(l) for l in nodelists]
+    if not lines:
+        return ""
+    lines.append("")
+    return "\n".join(lines)
+
+
 @wireprotocommand("between", "pairs")
 def between(repo, proto, pairs):
     pairs = [decodelist(p, "-") for p in pairs.split(" ")]
-    r = []
-    for b in repo.between(pairs):
-        r.append(encodelist(b) + "\n")
-    return "".join(r)
+    return _encodelines(repo.between(pairs))
 
 
 @wireprotocommand("branchmap")
 def branchmap(repo, proto):
     branchmap = repo.branchmap()
-    heads = []
-    for branch, nodes in pycompat.iteritems(branchmap):
-        branchname = urlreq.quote(encoding.fromlocal(branch))
-        branchnodes = encodelist(nodes)
-        heads.append("%s %s" % (branchname, branchnodes))
-    return "\n".join(heads)
+    return "\n".join(
+        [
+            "%s %s" % (quotebranch(encoding.fromlocal(branch)), encodelist(nodes))
+            for branch, nodes in pycompat.iteritems(branchmap)
+        ]
+    )
 
 
 @wireprotocommand("branches", "nodes")
 def branches(repo, proto, nodes):
     nodes = decodelist(nodes)
-    r = []
-    for b in repo.branches(nodes):
-        r.append(encodelist(b) + "\n")
-    return "".join(r)
+    return _encodelines(repo.branches(nodes))
 
 
 @wireprotocommand("clonebundles", "")
@@ -1286,6 +1368,21 @@ def unbundlereplay(repo, proto, heads, replaydata, respondlightly):
     return res
 
 
+def _advisesequential(fp):
+    """hint the kernel that fp is going to be read once from start to end
+
+    This doubles readahead on Linux. The pages do not need dropping
+    afterwards since the file is unlinked as soon as it is applied.
+    """
+    fadvise = getattr(os, "posix_fadvise", None)
+    if fadvise is None:
+        return
+    try:
+        fadvise(fp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except OSError:
+        pass
+
+
 @wireprotocommand("unbundle", "heads")
 def unbundle(repo, proto, heads):
     return unbundleimpl(repo, proto, heads)
@@ -1309,6 +1406,7 @@ def unbundleimpl(repo, proto, heads, replaydata=None, respondlightly=False):
         try:
             proto.getfile(fp)
             fp.seek(0)
+            _advisesequential(fp)
             gen = exchange.readbundle(repo.ui, fp, None)
             if isinstance(gen, changegroupmod.cg1unpacker) and not bundle1allowed(
                 repo, "push"
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import shutil
+import tempfile
+import unittest
+
+from edenscm.hgext.commitcloud import error as ccerror, syncstate
+from edenscm.mercurial import ui as uimod, vfs as vfsmod
+from edenscm.mercurial.pycompat import encodeutf8
+
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+workspace = "user/test/default"
+
+
+class fakerepo(object):
+    def __init__(self, path):
+        self.ui = uimod.ui()
+        self.svfs = vfsmod.vfs(path)
+
+
+class faketransaction(object):
+    def __init__(self, repo):
+        self.repo = repo
+
+    def addfilegenerator(self, genid, filenames, genfunc):
+        # write immediately, like the transaction does on close
+        for name in filenames:
+            with self.repo.svfs(name, "wb", atomictemp=True) as f:
+                genfunc(f)
+
+
+def jsoncodec():
+    return json.loads, lambda data: encodeutf8(json.dumps(data))
+
+
+def orjsoncodec():
+    return orjson.loads, orjson.dumps
+
+
+class testsyncstate(unittest.TestCase):
+    def setUp(self):
+        self._path = tempfile.mkdtemp("syncstatetest")
+        self.repo = fakerepo(self._path)
+        self._codec = syncstate._jsonloads, syncstate._jsondumps
+
+    def tearDown(self):
+        syncstate._jsonloads, syncstate._jsondumps = self._codec
+        shutil.rmtree(self._path, True)
+
+    def usecodec(self, loads, dumps):
+        syncstate._jsonloads, syncstate._jsondumps = loads, dumps
+
+    def save(self):
+        state = syncstate.SyncState(self.repo, workspace)
+        state.update(
+            faketransaction(self.repo),
+            newversion=3,
+            newheads=["a" * 40, "b" * 40],
+            newbookmarks={"book": "a" * 40, "caf\xe9": "b" * 40},
+            newremotebookmarks={"remote/master": "c" * 40},
+            newmaxage=14,
+            newomittedheads=["d" * 40],
+            newomittedbookmarks=["old"],
+            newomittedremotebookmarks=["remote/old"],
+        )
+
+    def assertloaded(self, state):
+        self.assertEqual(state.version, 3)
+        self.assertEqual(state.heads, ["a" * 40, "b" * 40])
+        self.assertEqual(state.bookmarks, {"book": "a" * 40, "caf\xe9": "b" * 40})
+        self.assertEqual(state.remotebookmarks, {"remote/master": "c" * 40})
+        self.assertEqual(state.maxage, 14)
+        self.assertEqual(state.omittedheads, ["d" * 40])
+        self.assertEqual(state.omittedbookmarks, ["old"])
+        self.assertEqual(state.omittedremotebookmarks, ["remote/old"])
+        self.assertIsNotNone(state.lastupdatetime)
+        for value in state.heads + list(state.bookmarks) + state.omittedheads:
+            self.assertIsInstance(value, str)
+
+    def testmissing(self):
+        state = syncstate.SyncState(self.repo, workspace)
+        self.assertEqual(state.version, 0)
+        self.assertEqual(state.heads, [])
+        self.assertEqual(state.bookmarks, {})
+        self.assertEqual(state.omittedheads, [])
+
+    def testjson(self):
+        self.usecodec(*jsoncodec())
+        self.save()
+        self.assertloaded(syncstate.SyncState(self.repo, workspace))
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def testorjson(self):
+        self.usecodec(*orjsoncodec())
+        self.save()
+        self.assertloaded(syncstate.SyncState(self.repo, workspace))
+
+    @unittest.skipIf(orjson is None, "orjson is not installed")
+    def testmixedcodecs(self):
+        # files written by either codec must load with the other
+        self.usecodec(*jsoncodec())
+        self.save()
+        self.usecodec(*orjsoncodec())
+        self.assertloaded(syncstate.SyncState(self.repo, workspace))
+        self.save()
+        self.usecodec(*jsoncodec())
+        self.assertloaded(syncstate.SyncState(self.repo, workspace))
+
+    def testoptionalfields(self):
+        filename = syncstate.SyncState._filename(workspace)
+        data = {"version": 1, "heads": ["a" * 40], "bookmarks": {}}
+        self.repo.svfs.write(filename, encodeutf8(json.dumps(data)))
+        state = syncstate.SyncState(self.repo, workspace)
+        self.assertEqual(state.version, 1)
+        self.assertEqual(state.heads, ["a" * 40])
+        self.assertEqual(state.remotebookmarks, {})
+        self.assertEqual(state.omittedheads, [])
+        self.assertIsNone(state.maxage)
+
+    def testinvalid(self):
+        self.save()
+        filename = syncstate.SyncState._filename(workspace)
+        self.repo.svfs.append(filename, b"}}}")
+        with self.assertRaises(ccerror.InvalidWorkspaceDataError):
+            syncstate.SyncState(self.repo, workspace)
+
+
+class testfilename(unittest.TestCase):
+    names = [
+        workspace,
+        "user/test/with space",
+        "a_b-c.d",
+        "us\xe9r/\u0442\u0435\u0441\u0442/\u9ed8\u8ba4",
+        "x\u0301y",
+        "\xb2\xbd\u216b\u0663",
+        "e\u200dmoji\U0001f600",
+    ]
+
+    def oldfilename(self, prefix, workspacename):
+        return (
+            prefix
+            + "".join(x for x in workspacename if x.isalnum())
+            + ".%s" % (hashlib.sha256(encodeutf8(workspacename)).hexdigest()[0:5])
+        )
+
+    def testmatchesisalnum(self):
+        for name in self.names:
+            self.assertEqual(
+                syncstate._filename("prefix.", name), self.oldfilename("prefix.", name)
+            )
+
+    def testrepeated(self):
+        for name in self.names:
+            first = syncstate._filename("prefix.", name)
+            self.assertEqual(syncstate._filename("prefix.", name), first)
+            classfirst = syncstate.SyncState._filename(name)
+            self.assertEqual(syncstate.SyncState._filename(name), classfirst)
+
+    def testprefixes(self):
+        # the memoized result must be keyed on the prefix too
+        for name in self.names:
+            a = syncstate._filename("a.", name)
+            b = syncstate._filename("b.", name)
+            self.assertEqual(a, self.oldfilename("a.", name))
+            self.assertEqual(b, self.oldfilename("b.", name))
+            self.assertEqual(syncstate._filename("a.", name), a)
+        self.assertEqual(
+            syncstate.SyncState._filename(workspace),
+            self.oldfilename(syncstate.SyncState.prefix, workspace),
+        )
+
+
+if __name__ == "__main__":
+    import silenttestrunner
+
+    silenttestrunner.main(__name__)
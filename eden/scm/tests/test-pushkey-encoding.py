@@ -0,0 +1,62 @@
+from __future__ import absolute_import
+
+import unittest
+
+from edenscm.mercurial import pushkey
+
+
+class testpushkeyencoding(unittest.TestCase):
+    def roundtrip(self, keys):
+        encoded = pushkey.encodekeys(keys)
+        self.assertIsInstance(encoded, bytes)
+        decoded = pushkey.decodekeys(encoded)
+        self.assertEqual(list(decoded.items()), list(keys))
+        return encoded
+
+    def testsimple(self):
+        keys = [("bookmarks/a", "0" * 40), ("bookmarks/b", "1" * 40)]
+        encoded = self.roundtrip(keys)
+        self.assertEqual(
+            encoded, b"bookmarks/a\t" + b"0" * 40 + b"\nbookmarks/b\t" + b"1" * 40
+        )
+
+    def testempty(self):
+        self.assertEqual(pushkey.encodekeys([]), b"")
+        self.assertEqual(list(pushkey.decodekeys(b"").items()), [])
+
+    def testorder(self):
+        # pullbackup relies on the server order being kept
+        self.roundtrip([("%d" % i, "v%d" % (99 - i)) for i in reversed(range(100))])
+
+    def testemptyvalue(self):
+        self.roundtrip([("deleted", ""), ("kept", "x")])
+
+    def testunicode(self):
+        self.roundtrip([("caf\xe9", "\u2603"), ("\u65e5\u672c", "v")])
+
+    def testlineseparators(self):
+        # str.splitlines() would break these, bytes.splitlines() does not
+        keys = [
+            ("vt\x0bkey", "ff\x0cvalue"),
+            ("fs\x1ckey", "nel\x85value"),
+            ("ls\u2028key", "ps\u2029value"),
+        ]
+        self.roundtrip(keys)
+
+    def testtrailingnewline(self):
+        decoded = pushkey.decodekeys(b"a\t1\nb\t2\n")
+        self.assertEqual(list(decoded.items()), [("a", "1"), ("b", "2")])
+
+    def testcrlf(self):
+        decoded = pushkey.decodekeys(b"a\t1\r\nb\t2\rc\t3")
+        self.assertEqual(list(decoded.items()), [("a", "1"), ("b", "2"), ("c", "3")])
+
+    def testmalformed(self):
+        with self.assertRaises(ValueError):
+            pushkey.decodekeys(b"notab")
+
+
+if __name__ == "__main__":
+    import silenttestrunner
+
+    silenttestrunner.main(__name__)
@@ -0,0 +1,210 @@
+from __future__ import absolute_import
+
+import unittest
+
+from edenscm.mercurial import pycompat, ui, util, wireproto
+
+
+urlreq = util.urlreq
+
+node1 = b"\x00" * 20
+node2 = b"\x12\x34" * 10
+node3 = b"\xff" * 20
+
+
+class testnodelists(unittest.TestCase):
+    def testroundtrip(self):
+        nodes = [node1, node2, node3]
+        encoded = wireproto.encodelist(nodes)
+        self.assertEqual(encoded, " ".join(n.hex() for n in nodes))
+        self.assertEqual(wireproto.decodelist(encoded), nodes)
+
+    def testseparator(self):
+        nodes = [node2, node3]
+        encoded = wireproto.encodelist(nodes, "-")
+        self.assertEqual(encoded, "%s-%s" % (node2.hex(), node3.hex()))
+        self.assertEqual(wireproto.decodelist(encoded, "-"), nodes)
+
+    def testempty(self):
+        self.assertEqual(wireproto.encodelist([]), "")
+        self.assertEqual(wireproto.decodelist(""), [])
+        self.assertEqual(wireproto.decodelist(wireproto.encodelist([])), [])
+
+    def testiterator(self):
+        self.assertEqual(
+            wireproto.encodelist(iter([node1, node2])),
+            wireproto.encodelist([node1, node2]),
+        )
+
+    def testnonnodes(self):
+        # entries that are not 20-byte nodes still encode one by one
+        encoded = wireproto.encodelist([b"\x01\x02", node1])
+        self.assertEqual(encoded, "0102 " + "00" * 20)
+
+    def testinvalid(self):
+        with self.assertRaises(TypeError):
+            wireproto.decodelist("zz")
+
+
+class testencodepairs(unittest.TestCase):
+    def _perpair(self, pairs):
+        return " ".join([wireproto.encodelist(p, "-") for p in pairs])
+
+    def testpairs(self):
+        pairs = [(node1, node2), (node3, node1), (node2, node3)]
+        self.assertEqual(wireproto._encodepairs(pairs), self._perpair(pairs))
+
+    def testempty(self):
+        self.assertEqual(wireproto._encodepairs([]), "")
+
+    def testfallback(self):
+        pairs = [(node1,), (node2, node3)]
+        self.assertEqual(wireproto._encodepairs(pairs), self._perpair(pairs))
+        pairs = [(b"\x01", node3)]
+        self.assertEqual(wireproto._encodepairs(pairs), self._perpair(pairs))
+
+    def testdecodes(self):
+        pairs = [(node1, node2), (node3, node1)]
+        decoded = [
+            tuple(wireproto.decodelist(p, "-"))
+            for p in wireproto._encodepairs(pairs).split(" ")
+        ]
+        self.assertEqual(decoded, pairs)
+
+
+class testbranchnames(unittest.TestCase):
+    names = [
+        "default",
+        "stable-1.0_rc~2",
+        "feature/x",
+        "with space",
+        "percent%20",
+        "tab\tand;semi",
+        "caf\xe9",
+        "",
+    ]
+
+    def testquote(self):
+        for name in self.names:
+            self.assertEqual(wireproto.quotebranch(name), urlreq.quote(name))
+
+    def testroundtrip(self):
+        for name in self.names:
+            quoted = wireproto.quotebranch(name)
+            self.assertEqual(wireproto.unquotebranch(quoted), name)
+            self.assertEqual(urlreq.unquote(quoted), name)
+
+
+class betweenpeer(wireproto.wirepeer):
+    """serves between requests with a server that returns the top of a pair"""
+
+    def __init__(self, caps):
+        self._caps = caps
+        self.batches = []
+        self.calls = 0
+        self.argsizes = []
+
+    @property
+    def ui(self):
+        return ui.ui()
+
+    def url(self):
+        return "test"
+
+    def local(self):
+        return None
+
+    def peer(self):
+        return self
+
+    def canpush(self):
+        return True
+
+    def close(self):
+        pass
+
+    def capabilities(self):
+        return self._caps
+
+    def _maxargsize(self):
+        # like ssh peers, arguments are not size limited
+        return None
+
+    def _serve(self, args):
+        self.argsizes.append(len(args["pairs"]))
+        pairs = [wireproto.decodelist(p, "-") for p in args["pairs"].split(" ")]
+        lines = "".join([wireproto.encodelist(p[:1]) + "\n" for p in pairs])
+        return pycompat.encodeutf8(lines)
+
+    def _call(self, cmd, **args):
+        self.calls += 1
+        return self._serve(args)
+
+    def _submitbatch(self, req):
+        self.batches.append(len(req))
+        return iter([self._serve(args) for _cmd, args in req])
+
+
+class httpbetweenpeer(betweenpeer):
+    """sends arguments the way HTTP peers do, in the URL or in headers"""
+
+    _maxargsize = wireproto.wirepeer._maxargsize
+
+
+class testbetween(unittest.TestCase):
+    pairs = [
+        (node1[:18] + b"%02d" % (i // 100), node2[:18] + b"%02d" % (i % 100))
+        for i in range(2000)
+    ]
+
+    def testbatched(self):
+        peer = betweenpeer(["batch"])
+        result = peer.between(self.pairs)
+        self.assertEqual(result, [[top] for top, _bottom in self.pairs])
+        # 8 chunks of 256 pairs, pipelined 4 per round trip
+        self.assertEqual(peer.batches, [4, 4])
+        self.assertEqual(peer.calls, 0)
+
+    def testserial(self):
+        peer = betweenpeer([])
+        result = peer.between(self.pairs)
+        self.assertEqual(result, [[top] for top, _bottom in self.pairs])
+        self.assertEqual(peer.batches, [])
+        self.assertEqual(peer.calls, 8)
+
+    def testsinglechunk(self):
+        peer = betweenpeer(["batch"])
+        result = peer.between(self.pairs[:3])
+        self.assertEqual(result, [[top] for top, _bottom in self.pairs[:3]])
+        self.assertEqual(peer.batches, [])
+        self.assertEqual(peer.calls, 1)
+
+    def testquerystring(self):
+        peer = httpbetweenpeer(["batch"])
+        result = peer.between(self.pairs)
+        self.assertEqual(result, [[top] for top, _bottom in self.pairs])
+        # a handful of pairs per request, never batched into one URL
+        self.assertEqual(peer.batches, [])
+        self.assertEqual(peer.calls, 167)
+        self.assertLessEqual(max(peer.argsizes), 1024)
+
+    def testhttpheader(self):
+        peer = httpbetweenpeer(["batch", "httpheader=1024"])
+        result = peer.between(self.pairs)
+        self.assertEqual(result, [[top] for top, _bottom in self.pairs])
+        self.assertEqual(peer.batches, [])
+        self.assertEqual(peer.calls, 21)
+        self.assertLessEqual(max(peer.argsizes), 8 * 1024)
+
+    def testlargehttpheader(self):
+        peer = httpbetweenpeer(["batch", "httpheader=65536"])
+        result = peer.between(self.pairs)
+        self.assertEqual(result, [[top] for top, _bottom in self.pairs])
+        self.assertEqual(peer.batches, [4, 4])
+        self.assertEqual(peer.calls, 0)
+
+
+if __name__ == "__main__":
+    import silenttestrunner
+
+    silenttestrunner.main(__name__)